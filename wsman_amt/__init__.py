@@ -0,0 +1,33 @@
+"""Intel AMT configuration through WS-Man
+
+    from wsman_amt import wsman_amt
+
+    with wsman_amt('10.0.0.5', 'admin', 'secret') as a:
+        print(a.get_powerstate().state_name)
+
+The WS-Man transport is imported on the first request. Metrics and
+the HTTP API are in wsman_amt.metrics and wsman_amt.server.
+"""
+
+from .amt import wsman_amt
+from .cache import wsman_cache
+from .errors import amt_error, amt_connection_error, amt_connect_error, \
+    amt_timeout_error, amt_unavailable_error, amt_auth_error, amt_busy_error, \
+    amt_response_error, amt_fault
+from .reconcile import load_desired_state
+from .retry import retry_policy, circuit_breaker
+from .schedule import host_scheduler
+from .results import amt_result, identify_result, power_result, \
+    redirection_result, kvm_result, status_result, change_result, \
+    reconcile_result, instance_result, enumeration_result
+from .session import wsman_session, default_transport
+
+__all__ = ['wsman_amt', 'wsman_cache', 'amt_error', 'amt_connection_error',
+           'amt_connect_error', 'amt_timeout_error', 'amt_unavailable_error',
+           'amt_auth_error', 'amt_busy_error', 'amt_response_error',
+           'amt_fault', 'load_desired_state', 'retry_policy',
+           'circuit_breaker', 'host_scheduler', 'amt_result',
+           'identify_result', 'power_result', 'redirection_result',
+           'kvm_result', 'status_result', 'change_result', 'reconcile_result',
+           'instance_result', 'enumeration_result', 'wsman_session',
+           'default_transport']
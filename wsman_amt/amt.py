@@ -0,0 +1,684 @@
+"""Intel AMT configuration through WS-Man"""
+
+import functools
+import random
+import sys
+import time
+
+from .errors import amt_fault, amt_response_error, amt_busy_error
+from .results import identify_result, power_result, redirection_result, \
+    kvm_result, status_result, change_result, reconcile_result, \
+    instance_result
+from .session import wsman_session
+from .soap import XML_NS_ADDRESSING, XML_NS_WS_MAN, XML_NS_WSMAN_ID, \
+    XML_NS_CIM_CLASS, XML_NS_AMT_CLASS, XML_NS_IPS_CLASS, WSA_TO_ANONYMOUS, \
+    wsman_doc, wsman_options
+
+def exclusive(method):
+    """Run 'method' as one read-modify-write sequence on the endpoint"""
+    @functools.wraps(method)
+    def run(self, *args, **kwargs):
+        with self.client.exclusive():
+            return method(self, *args, **kwargs)
+    return run
+
+class wsman_amt:
+    """Class for handling Intel AMT configuration
+
+    Methods return amt_result objects. Errors raise amt_error
+    subclasses: amt_connection_error and its subclasses if the endpoint
+    does not respond, amt_auth_error for wrong credentials, amt_fault
+    for SOAP faults, amt_busy_error if the firmware is busy and
+    amt_response_error for unexpected responses; invalid arguments
+    raise ValueError. With debug()
+    enabled requests and responses are printed to 'out', which is to
+    be set before.
+    """
+
+    redirection_state_map = { 32768: 'IDER and SOL are disabled',
+                              32769: 'IDER is enabled and SOL is disabled',
+                              32770: 'SOL is enabled and IDER is disabled',
+                              32771: 'IDER and SOL are enabled' }
+    power_request_map = { 'on': 2, 'sleep': 3, 'deep-sleep': 4, 'soft-reset':5,
+                          'off': 6, 'hibernate': 7, 'soft-off': 8,
+                          'reset': 9, 'bus-reset': 10, 'nmi': 11,
+                          'graceful-soft-off': 12, 'graceful-off': 13,
+                          'graceful-bus-reset': 14, 'graceful-soft-reset': 15,
+                          'graceful-reset': 16 }
+    # Power states a request settles in; the others are actions
+    # which are always carried out
+    power_converged_map = { 'on': [2], 'sleep': [3], 'deep-sleep': [4],
+                            'hibernate': [7], 'off': [6, 8], 'soft-off': [6, 8],
+                            'graceful-off': [6, 8], 'graceful-soft-off': [6, 8] }
+    # Power cycles, which pass through off on the way back to on; bus
+    # resets and NMI keep the system on and have nothing to wait for
+    power_cycle_states = ('soft-reset', 'reset', 'graceful-soft-reset',
+                          'graceful-reset')
+    # Polling interval bounds in seconds for wait_powerstate()
+    power_wait_interval = (0.5, 8.0)
+    # Schema of a class name by its prefix, for enumerate()
+    class_schema_map = { 'AMT_': XML_NS_AMT_CLASS, 'IPS_': XML_NS_IPS_CLASS,
+                         'CIM_': XML_NS_CIM_CLASS }
+
+    def __init__(self, ipaddress, username, password, port=16992,
+                 timeout=None, transport=None, cache=None, metrics=None,
+                 scheduler=None, retry=None):
+        self.ipaddress = ipaddress
+        self.username = username
+        self.password = password
+        self.port = str(port)
+        self.url = 'http://' + self.username + ':' + self.password + '@' + self.ipaddress + ':' + self.port + '/wsman'
+        self.client = wsman_session(self.url, timeout, transport, cache,
+                                    metrics, scheduler, retry)
+        self.options = wsman_options()
+        self.debug_level = 0
+        self.out = sys.stdout
+
+    def close(self):
+        self.client.close()
+
+    def abort(self):
+        """Give up on the operation in progress, see wsman_session.abort()"""
+        self.client.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def debug(self, debug):
+        self.debug_level = debug
+        if (self.debug_level):
+            self.options.set_dump_request(self.out)
+
+    def response(self, doc, what):
+        """Return 'doc' after raising amt_fault if it is a fault"""
+        if (self.debug_level):
+            print("%s" % doc, file=self.out)
+        if doc.is_fault():
+            raise amt_fault(what, doc.fault())
+        return doc
+
+    def instance(self, doc, ns):
+        """Return the instance or method output in 'doc'"""
+        body = doc.body()
+        if body is not None:
+            for instance in body:
+                return instance
+        raise amt_response_error(f'{ns}: empty response')
+
+    def nodes(self, doc, ns):
+        """Return the properties in 'ns' of the instance or method
+        output in 'doc' by name, from one pass over its elements; of
+        repeated properties the first one"""
+        nodes = {}
+        for node in self.instance(doc, ns):
+            if node.ns() == ns:
+                nodes.setdefault(node.name(), node)
+        return nodes
+
+    def fields(self, doc, ns, *names, optional=()):
+        """Return the text of properties 'names', which must all be
+        present, followed by those of 'optional', None if missing"""
+        nodes = self.nodes(doc, ns)
+        missing = [name for name in names if name not in nodes]
+        if missing:
+            raise amt_response_error(f'{ns}: no {", ".join(missing)} in response')
+        return [nodes[name].__str__() for name in names] + \
+            [nodes[name].__str__() if name in nodes else None for name in optional]
+
+    def find(self, doc, ns, name):
+        """Return the text of property 'name', which must be present"""
+        return self.fields(doc, ns, name)[0]
+
+    def identify(self):
+        doc = self.client.identify( self.options )
+        return self.parse_identify(doc)
+
+    def parse_identify(self, doc):
+        self.response(doc, 'Identify')
+        root = doc.root()
+        prod_vendor = root.find( XML_NS_WSMAN_ID, "ProductVendor" )
+        prod_version = root.find( XML_NS_WSMAN_ID, "ProductVersion" )
+        if self.client.metrics is not None:
+            self.client.metrics.firmware( self.client.endpoint,
+                                          str(prod_vendor), str(prod_version) )
+        return identify_result(str(prod_vendor), str(prod_version))
+
+    def get_redirection(self, cached=True):
+        ns = XML_NS_AMT_CLASS + '/AMT_RedirectionService'
+        doc = self.client.get( self.options, ns, cached )
+        return self.parse_redirection(doc)
+
+    def parse_redirection(self, doc):
+        method = 'AMT_RedirectionService'
+        enabled_state_map = ['Unknown', 'Other',
+                             'Enabled', 'Disabled',
+                             'Shutting Down',
+                             'Not Applicable',
+                             'Enabled but Offline',
+                             'In Test', 'Deferred',
+                             'Quiesce', 'Starting']
+        ns = XML_NS_AMT_CLASS + '/' + method
+        self.response(doc, method)
+        element, state, enabled = self.fields( doc, ns, "ElementName",
+                                               "EnabledState", "ListenerEnabled" )
+        state = int(state)
+        if (state < 11):
+            enabled_state = enabled_state_map[state]
+        elif (state < 32768):
+            enabled_state = 'DMTF Reserved'
+        elif (state in self.redirection_state_map):
+            enabled_state = self.redirection_state_map[state]
+        else:
+            enabled_state = 'Vendor Reserved'
+        redirection = state in self.redirection_state_map
+        return redirection_result(element, state, enabled_state,
+                                  redirection and state & 2 != 0,
+                                  redirection and state & 1 != 0,
+                                  enabled == 'true')
+
+    def diff(self, ns, doc, desired):
+        """Return the entries of 'desired' which differ from the
+        properties of 'doc'"""
+        current = dict(zip(desired, self.fields( doc, ns, *desired )))
+        return {name: value for name, value in desired.items()
+                if current[name] != value}
+
+    def apply(self, ns, doc, desired, secrets={}, force=False):
+        """Put 'doc' back with the properties from 'desired', but only
+        if any of them differ or with 'force'. Write-only properties in
+        'secrets' are sent along with other changes but never cause a
+        write. Returns the changed properties and the Put response,
+        which is None if nothing needed to be written."""
+        nodes = self.nodes(doc, ns)
+        changes = {}
+        for name, value in desired.items():
+            if name not in nodes:
+                raise amt_response_error(f'{ns}: no {name} in response')
+            if nodes[name].__str__() != value:
+                changes[name] = value
+        if not changes and not force:
+            return changes, None
+        for name, value in changes.items():
+            nodes[name].set_text( value )
+        for name, value in secrets.items():
+            # Write-only properties may be left out of the response
+            if name in nodes:
+                nodes[name].set_text( value )
+            else:
+                self.instance(doc, ns).add( ns, name, value )
+        # The document is serialized once, by the transport
+        return changes, self.client.put( self.options, ns, doc )
+
+    @exclusive
+    def set_redirection_listener(self, action):
+        method = 'AMT_RedirectionService'
+        ns = XML_NS_AMT_CLASS + '/' + method
+        if action == 'enable':
+            state = 'true'
+        elif action == 'disable':
+            state = 'false'
+        else:
+            raise ValueError(f'Invalid action {action}')
+        orig_doc = self.response(self.client.get( self.options, ns, cached=False ),
+                                 method)
+        changes, doc = self.apply( ns, orig_doc, {'ListenerEnabled': state} )
+        if not changes:
+            return change_result(False, f'Listener already in state {action}')
+        self.response(doc, method)
+        if not self.diff( ns, doc, changes ):
+            return change_result(True, f'Listener changed to {state}')
+        return change_result(False, f'Failed to change listener to {action}',
+                             ok=False)
+
+    @exclusive
+    def set_redirection(self, serial, ider):
+        method = 'AMT_RedirectionService'
+        ns = XML_NS_AMT_CLASS + '/' + method
+        orig_doc = self.response(self.client.get( self.options, ns, cached=False ),
+                                 method)
+        state = int(self.find( orig_doc, ns, "EnabledState" ))
+        if state not in self.redirection_state_map:
+            raise amt_response_error(f'Invalid redirection state {state}')
+        new_state = self.redirection_target(state, serial, ider)
+        if new_state == state:
+            return change_result(False, f'Nothing to do, {self.redirection_state_map[state]}')
+        doc = self.response(self.redirection_state_change(new_state), method)
+        value = int(self.find( doc, ns, "ReturnValue" ))
+        if value == 0:
+            return change_result(True, f'Redirection changed, {self.redirection_state_map[new_state]}',
+                                 return_value=0)
+        status = self.return_status(value)
+        return change_result(False, f'Setting redirection state to {new_state} failed, {status}',
+                             ok=False, return_value=value)
+
+    def redirection_target(self, state, serial, ider):
+        """Return the EnabledState of AMT_RedirectionService with SOL and
+        IDER changed to 'enable' or 'disable', or kept if None"""
+        # Bit 1 is SOL, bit 0 is IDER
+        if serial is not None:
+            state = state & ~2 | (2 if serial == 'enable' else 0)
+        if ider is not None:
+            state = state & ~1 | (1 if ider == 'enable' else 0)
+        return state
+
+    def redirection_state_change(self, new_state):
+        ns = XML_NS_AMT_CLASS + '/AMT_RedirectionService'
+        method = 'RequestStateChange'
+        data = wsman_doc(method + '_INPUT', ns)
+        input = data.root()
+        input.add( ns, 'RequestedState', str(new_state) )
+        return self.client.invoke( self.options, ns, method, data )
+
+    def kvm_redirection(self, action):
+        method = 'IPS_KVMRedirectionSettingData'
+        ns = XML_NS_IPS_CLASS + '/' + method
+        if action not in ('status', 'enable', 'disable'):
+            raise ValueError(f'Invalid KVM redirection action {action}')
+        if action == 'status':
+            return self.parse_kvm(self.client.get( self.options, ns, cached=True ))
+        return self.set_kvm_redirection(action)
+
+    @exclusive
+    def set_kvm_redirection(self, action):
+        method = 'IPS_KVMRedirectionSettingData'
+        ns = XML_NS_IPS_CLASS + '/' + method
+        if action == 'disable':
+            # Whether a session is open cannot be read, so terminate
+            # any in any case
+            doc = self.client.invoke( self.options, ns, 'TerminateSession', None )
+            self.response(doc, f'{method} TerminateSession')
+            return change_result(True, 'KVM redirection disabled')
+
+        orig_doc = self.client.get( self.options, ns, cached=False )
+        self.response(orig_doc, method)
+        desired = { 'Is5900PortEnabled': 'true', 'OptInPolicy': 'false',
+                    'SessionTimeout': '0' }
+        changes, doc = self.apply( ns, orig_doc, desired,
+                                   { 'RFBPassword': self.password } )
+        if not changes:
+            return change_result(False, 'KVM redirection already enabled')
+        self.response(doc, method)
+        return change_result(True, 'KVM redirection enabled')
+
+    def parse_kvm(self, doc):
+        method = 'IPS_KVMRedirectionSettingData'
+        ns = XML_NS_IPS_CLASS + '/' + method
+        self.response(doc, method)
+        e, p, t = self.fields( doc, ns, "Is5900PortEnabled", "OptInPolicy",
+                               "SessionTimeout" )
+        return kvm_result(e == 'true', p == 'true', int(t))
+
+    @exclusive
+    def start_kvm_redirection(self):
+        class_name = 'CIM_KVMRedirectionSAP'
+        method = 'RequestStateChange'
+        ns = XML_NS_CIM_CLASS + '/' + class_name
+        doc = self.client.get( self.options, ns, cached=False )
+        if not doc.is_fault():
+            if not self.diff( ns, doc, { 'EnabledState': '2' } ):
+                return change_result(False, 'KVM redirection already started')
+        data = wsman_doc( method + '_INPUT', ns )
+        input = data.root()
+        input.add( ns, 'RequestedState', '2' )
+        doc = self.client.invoke( self.options, ns, method, data )
+        self.response(doc, f'{class_name} {method}')
+        code = int(self.find( doc, ns, 'ReturnValue' ))
+        if code == 0:
+            return change_result(True, 'KVM redirection started', return_value=code)
+        if code == 3:
+            return change_result(False, 'KVM redirection could not be enabled before timeout',
+                                 ok=False, return_value=code)
+        if code == 5:
+            return change_result(False, 'KVM redirection could not be enabled, invalid requested state',
+                                 ok=False, return_value=code)
+        if code == 4096:
+            return change_result(True, 'KVM redirection successfully initiated',
+                                 return_value=code)
+        return change_result(False, f'KVM redirection could not be started, error code {code}',
+                             ok=False, return_value=code)
+
+    def resource_uri(self, resource):
+        """Return the resource URI of a class name such as
+        'AMT_EventLogEntry'; URIs are returned unchanged"""
+        if '://' in resource:
+            return resource
+        schema = self.class_schema_map.get(resource[:4])
+        if schema is None:
+            raise ValueError(f'Unknown class {resource}, expected AMT_, IPS_ or CIM_')
+        return schema + '/' + resource
+
+    def enumerate(self, resource, max_elements=32):
+        """Yield an instance_result for each instance of 'resource',
+        a class name or resource URI, as the Pull responses of up to
+        'max_elements' instances come in"""
+        uri = self.resource_uri(resource)
+        name = uri.rpartition('/')[2]
+        if max_elements < 1:
+            raise ValueError(f'Invalid number of elements {max_elements}')
+        for node in self.client.enumerate( self.options, uri, max_elements ):
+            if (self.debug_level):
+                print("%s" % wsman_doc(node.elem), file=self.out)
+            yield instance_result(name, self.properties(node))
+
+    def properties(self, node):
+        """Return the properties of the instance 'node' as a dict;
+        repeated properties become lists, structured ones dicts"""
+        props = {}
+        for child in node:
+            value = self.properties(child) if len(child.elem) else str(child)
+            name = child.name()
+            if name not in props:
+                props[name] = value
+            elif isinstance(props[name], list):
+                props[name].append(value)
+            else:
+                props[name] = [props[name], value]
+        return props
+
+    def get_powerstate(self, cached=True):
+        ns = XML_NS_CIM_CLASS + '/CIM_AssociatedPowerManagementService'
+        doc = self.client.get( self.options, ns, cached )
+        return self.parse_powerstate(doc)
+
+    def wait_powerstate(self, requested_state, timeout):
+        """Poll the power state until 'requested_state' is reached or
+        'timeout' seconds have passed; returns the last power_result
+        and whether it matches. The polling interval doubles from
+        power_wait_interval[0] up to power_wait_interval[1], each
+        sleep being jittered so that hosts rebooted together do not
+        poll in lockstep. Power cycles end once the system was seen
+        off and is on again."""
+        targets = self.power_converged_map.get(requested_state, [2])
+        left = requested_state not in self.power_cycle_states
+        deadline = time.monotonic() + timeout
+        interval, max_interval = self.power_wait_interval
+        while True:
+            power = self.get_powerstate(cached=False)
+            if power.state not in targets:
+                left = True
+            elif left:
+                return power, True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return power, False
+            time.sleep(min(random.uniform(interval / 2, interval), remaining))
+            interval = min(interval * 2, max_interval)
+
+    def parse_powerstate(self, doc):
+        power_state_map = ['unknown', 'other', 'on', 'sleep', 'deep-sleep',
+                           'soft-reset', 'off',  'hibernate',
+                           'soft-off', 'reset', 'bus-reset', 'nmi',
+                           'graceful-soft-off', 'graceful-off',
+                           'graceful-bus-reset', 'graceful-soft-reset',
+                           'graceful-reset', 'diag']
+        requested_state_map = ['unknown', 'other', 'on', 'sleep', 'deep-sleep',
+                               'soft-reset', 'off', 'hibernate', 'soft-off',
+                               'reset', 'bus-reset', 'nmi', 'n/a',
+                               'graceful-soft-off', 'graceful-off',
+                               'graceful-bus-reset', 'graceful-soft-reset',
+                               'graceful-reset', 'diag']
+        available_state_map = ['unknown', 'other', 'on', 'sleep', 'deep-sleep',
+                               'soft-reset', 'off', 'hibernate', 'soft-off',
+                               'reset', 'bus-reset', 'nmi',
+                               'graceful-soft-off', 'graceful-off',
+                               'graceful-bus-reset', 'graceful-soft-reset',
+                               'graceful-reset']
+        method = 'CIM_AssociatedPowerManagementService'
+        ns = XML_NS_CIM_CLASS + '/' + method
+        self.response(doc, method)
+        power, available, requested = self.fields( doc, ns, "PowerState",
+                                                   "AvailableRequestedPowerStates",
+                                                   optional=["RequestedPowerState"] )
+        if (requested is None):
+            requested_value = None
+            requested_state = 'None'
+        else:
+            requested_value = int(requested)
+            if (requested_value < 18):
+                requested_state = requested_state_map[requested_value]
+            elif (requested_value < 32768):
+                requested_state = 'DMTF Reserved (' + requested + ')'
+            else:
+                requested_state = 'Vendor Reserved (' + requested + ')'
+        power = int(power)
+        if (power < 17):
+            power_state = power_state_map[power]
+        elif (power < 32768):
+            power_state = 'DMTF Reserved (' + str(power) + ')'
+        else:
+            power_state = 'Vendor Reserved (' + str(power) + ')'
+        available = int(available)
+        if (available < 17):
+            available_state = available_state_map[available]
+        elif (available < 32768):
+            available_state = 'DMTF Reserved (' + str(available) + ')'
+        else:
+            available_state = 'Vendor Reserved (' + str(available) + ')'
+        return power_result(power, power_state,
+                            requested_value, requested_state,
+                            available, available_state)
+
+    def get_status(self, full=False):
+        """Fetch power and redirection state, and with 'full' also the
+        firmware identity and KVM settings, as one pipelined batch"""
+        requests = [('get', XML_NS_CIM_CLASS + '/CIM_AssociatedPowerManagementService'),
+                    ('get', XML_NS_AMT_CLASS + '/AMT_RedirectionService')]
+        if full:
+            requests.insert(0, ('identify',))
+            requests.append(('get', XML_NS_IPS_CLASS + '/IPS_KVMRedirectionSettingData'))
+        docs = self.client.pipeline( self.options, requests, cached=True )
+        identify = None
+        kvm = None
+        if full:
+            identify = self.parse_identify(docs.pop(0))
+            kvm = self.parse_kvm(docs[2])
+        return status_result(identify, self.parse_powerstate(docs[0]),
+                             self.parse_redirection(docs[1]), kvm)
+
+    def power_converged(self, doc, requested_state):
+        """Check whether the CIM_AssociatedPowerManagementService 'doc'
+        already is in 'requested_state'"""
+        ns = XML_NS_CIM_CLASS + '/CIM_AssociatedPowerManagementService'
+        if requested_state not in self.power_converged_map:
+            return False
+        power = self.nodes(doc, ns).get("PowerState")
+        return power is not None and \
+            int(power.__str__()) in self.power_converged_map[requested_state]
+
+    def set_powerstate(self, requested_state, wait=None):
+        """Request 'requested_state'; with 'wait' also wait up to that
+        many seconds for the system to get there"""
+        if requested_state not in self.power_request_map:
+            raise ValueError(f'Invalid power state {requested_state}')
+        if wait and requested_state not in self.power_converged_map and \
+           requested_state not in self.power_cycle_states:
+            raise ValueError(f'Cannot wait for {requested_state}, the system stays on')
+        result = self.request_powerstate(requested_state)
+        if not wait or not result.changed or not result.ok:
+            return result
+        start = time.monotonic()
+        power, done = self.wait_powerstate(requested_state, wait)
+        elapsed = time.monotonic() - start
+        if not done:
+            return change_result(True, f'{result.message}, still {power.state_name} after {elapsed:.1f}s',
+                                 ok=False, return_value=result.return_value)
+        result.message += f', {power.state_name} after {elapsed:.1f}s'
+        return result
+
+    @exclusive
+    def request_powerstate(self, requested_state):
+        if requested_state in self.power_converged_map:
+            ns = XML_NS_CIM_CLASS + '/CIM_AssociatedPowerManagementService'
+            doc = self.client.get( self.options, ns, cached=False )
+            if not doc.is_fault() and \
+               self.power_converged(doc, requested_state):
+                return change_result(False, f'Powerstate already {requested_state}')
+        ns = XML_NS_CIM_CLASS + '/CIM_PowerManagementService'
+        doc = self.response(self.power_state_change(requested_state),
+                            'CIM_PowerManagementService RequestPowerStateChange')
+        code = int(self.find( doc, ns, "ReturnValue" ))
+        status = self.return_status(code)
+        message = f'Set powerstate to {requested_state}: {status}'
+        if code not in (0, 4096):
+            return change_result(False, message, ok=False, return_value=code)
+        return change_result(True, message, return_value=code)
+
+    def power_state_change(self, requested_state):
+        state = self.power_request_map[requested_state]
+        ns = XML_NS_CIM_CLASS + '/CIM_PowerManagementService'
+        method = 'RequestPowerStateChange'
+        selector = 'CIM_ComputerSystem'
+        data = wsman_doc(method + '_INPUT', ns)
+        input = data.root()
+        input.add( ns, 'PowerState', str(state))
+        elem = input.add(ns, 'ManagedElement', '')
+        elem.add( XML_NS_ADDRESSING, 'Address', WSA_TO_ANONYMOUS )
+        ref = elem.add( XML_NS_ADDRESSING, 'ReferenceParameters', '')
+        ref.add( XML_NS_WS_MAN, 'ResourceURI', XML_NS_CIM_CLASS + '/' + selector)
+        sel = ref.add( XML_NS_WS_MAN, 'SelectorSet', '')
+        class_name = sel.add( XML_NS_WS_MAN, 'Selector', selector)
+        class_name.attr_add( None, 'Name', 'CreationClassName')
+        name = sel.add( XML_NS_WS_MAN, 'Selector', 'ManagedSystem')
+        name.attr_add( None, 'Name', 'Name')
+        if (self.debug_level):
+            print("%s" % data, file=self.out)
+        return self.client.invoke( self.options, ns, method, data )
+
+    def put_error(self, ns, doc, changes):
+        """Check a Put response for 'changes' having been applied;
+        returns an error message or None"""
+        if (self.debug_level):
+            print("%s" % doc, file=self.out)
+        if doc.is_fault():
+            return doc.fault().reason()
+        if self.diff( ns, doc, changes ):
+            return 'not applied'
+        return None
+
+    def invoke_error(self, ns, doc):
+        """Check an Invoke response for successful completion;
+        returns an error message or None"""
+        if (self.debug_level):
+            print("%s" % doc, file=self.out)
+        if doc.is_fault():
+            return doc.fault().reason()
+        value = int(self.find( doc, ns, "ReturnValue" ))
+        if value not in (0, 4096):
+            return self.return_status(value)
+        return None
+
+    @exclusive
+    def reconcile(self, desired):
+        """Bring the system into the 'desired' state, a dict as returned
+        by load_desired_state(). Current state is read in one batch and
+        only differing settings are written; settings which cannot be
+        applied are reported in the result rather than raised."""
+        power_ns = XML_NS_CIM_CLASS + '/CIM_AssociatedPowerManagementService'
+        redir_ns = XML_NS_AMT_CLASS + '/AMT_RedirectionService'
+        kvm_ns = XML_NS_IPS_CLASS + '/IPS_KVMRedirectionSettingData'
+        kvm_map = { 'kvm_port_5900': 'Is5900PortEnabled',
+                    'kvm_opt_in': 'OptInPolicy',
+                    'kvm_session_timeout': 'SessionTimeout' }
+
+        def text(value):
+            if isinstance(value, bool):
+                return 'true' if value else 'false'
+            return str(value)
+
+        def action(value):
+            if value is None:
+                return None
+            return 'enable' if value else 'disable'
+
+        uris = []
+        if 'power' in desired:
+            uris.append(power_ns)
+        if desired.keys() & {'sol', 'ider', 'listener'}:
+            uris.append(redir_ns)
+        if desired.keys() & (kvm_map.keys() | {'kvm_password'}):
+            uris.append(kvm_ns)
+        docs = self.client.pipeline( self.options, [('get', u) for u in uris],
+                                   cached=False )
+        docs = dict(zip(uris, docs))
+        for uri, doc in docs.items():
+            self.response(doc, uri)
+
+        changed = []
+        failed = {}
+
+        def record(name, error):
+            if error is None:
+                changed.append(name)
+            else:
+                failed[name] = error
+
+        def invoke(name, ns, request):
+            try:
+                record(name, self.invoke_error( ns, request() ))
+            except amt_busy_error:
+                record(name, self.return_status(4099))
+
+        if redir_ns in docs:
+            doc = docs[redir_ns]
+            if 'listener' in desired:
+                want = { 'ListenerEnabled': text(desired['listener']) }
+                changes, resp = self.apply( redir_ns, doc, want )
+                if changes:
+                    record('listener', self.put_error( redir_ns, resp, changes ))
+            state = int(self.find( doc, redir_ns, "EnabledState" ))
+            new_state = self.redirection_target(state,
+                                                action(desired.get('sol')),
+                                                action(desired.get('ider')))
+            if new_state != state:
+                invoke('redirection', redir_ns,
+                       lambda: self.redirection_state_change(new_state))
+        if kvm_ns in docs:
+            want = { kvm_map[k]: text(v) for k, v in desired.items()
+                     if k in kvm_map }
+            secrets = {}
+            if 'kvm_password' in desired:
+                secrets['RFBPassword'] = desired['kvm_password']
+            # The password cannot be read back to compare, so it is
+            # written every time
+            changes, resp = self.apply( kvm_ns, docs[kvm_ns], want, secrets,
+                                        force=bool(secrets) )
+            if resp is not None:
+                error = self.put_error( kvm_ns, resp, changes )
+                if changes:
+                    record('kvm', error)
+                if secrets:
+                    record('kvm_password', error)
+        if power_ns in docs and \
+           not self.power_converged(docs[power_ns], desired['power']):
+            invoke('power', XML_NS_CIM_CLASS + '/CIM_PowerManagementService',
+                   lambda: self.power_state_change(desired['power']))
+
+        return reconcile_result(changed, failed)
+
+    def return_status(self, value):
+        """Decode the ReturnValue of a CIM state change method"""
+        return_value_map = [ 'Completed with No Error', 'Not Supported',
+                             'Unknown or Unspecified Error',
+                             'Cannot complete within Timeout Period',
+                             'Failed', 'Invalid Parameter', 'In Use' ]
+        value = int(value.__str__())
+        if ( value < 7 ):
+            status = return_value_map[value]
+        elif ( value < 4096 ):
+            status = 'DMTF Reserved (' + str(value) + ')'
+        elif ( value == 4096 ):
+            status = 'Method Parameters Checked - Job Started'
+        elif ( value == 4097 ):
+            status = 'Invalid State Transition'
+        elif ( value == 4098 ):
+            status = 'Use of Timeout Parameter Not Supported'
+        elif ( value == 4099 ):
+            status = 'Busy'
+        elif ( value < 32768 ):
+            status = 'Method Reserved'
+        else:
+            status = 'Vendor Specific (' + str(value) + ')'
+        return status
@@ -0,0 +1,234 @@
+"""Throughput and latency benchmarks of wsman_amt
+
+Runs an operation repeatedly against one host and against a fleet
+of hosts and reports operations per second and p50/p99 latency.
+Without --target a mock endpoint (see wsman_amt.mock) is started
+for the run:
+
+    python3 -m wsman_amt.bench --op status --hosts 32 -c 8 --latency 5
+"""
+
+import argparse
+import json
+import math
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .amt import wsman_amt
+from .cache import wsman_cache
+from .errors import amt_error
+from .metrics import wsman_metrics
+from .retry import retry_policy
+from .session import default_transport
+
+bench_op_map = {
+    'identify': lambda a, i: a.identify(),
+    'power': lambda a, i: a.get_powerstate(),
+    'status': lambda a, i: a.get_status(),
+    'status-all': lambda a, i: a.get_status(True),
+    'listener': lambda a, i: a.set_redirection_listener(('disable', 'enable')[i % 2]),
+    'reset': lambda a, i: a.set_powerstate('reset'),
+    'enumerate': lambda a, i: sum(1 for _ in a.enumerate('AMT_EventLogEntry')),
+}
+
+class bench_result:
+    """Latencies of the successful operations of one run"""
+
+    def __init__(self, name, hosts, concurrency):
+        self.name = name
+        self.hosts = hosts
+        self.concurrency = concurrency
+        self.latencies = []
+        self.errors = 0
+        self.elapsed = 0
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        lat = sorted(self.latencies)
+        return lat[max(0, math.ceil(q / 100 * len(lat)) - 1)]
+
+    def rate(self):
+        return len(self.latencies) / self.elapsed if self.elapsed else 0
+
+    def as_dict(self):
+        ms = lambda v: None if v is None else round(v * 1000, 3)
+        return { 'name': self.name, 'hosts': self.hosts,
+                 'concurrency': self.concurrency,
+                 'ops': len(self.latencies), 'errors': self.errors,
+                 'elapsed': round(self.elapsed, 3),
+                 'ops_per_sec': round(self.rate(), 1),
+                 'p50_ms': ms(self.percentile(50)),
+                 'p99_ms': ms(self.percentile(99)) }
+
+    def __str__(self):
+        d = self.as_dict()
+        hosts = f'{self.hosts} host' + ('s' if self.hosts != 1 else '')
+        return (f'{self.name:<8} {hosts:>10} x{self.concurrency:<4}'
+                f'{d["ops"]:>8} ops {d["ops_per_sec"]:>10.1f} ops/s'
+                f'  p50 {d["p50_ms"] or 0:8.2f} ms  p99 {d["p99_ms"] or 0:8.2f} ms'
+                f'  {self.errors} errors')
+
+def run_bench(name, endpoints, concurrency, args, metrics=None):
+    """Run args.op args.ops times on each of 'endpoints', (address, port)
+    tuples, with up to 'concurrency' hosts at a time"""
+    op = bench_op_map[args.op]
+    cache = wsman_cache(args.cache_ttl) if args.cache_ttl > 0 else None
+    retry = retry_policy(args.retries + 1, args.backoff)
+    result = bench_result(name, len(endpoints), concurrency)
+
+    def connect(address, port):
+        return wsman_amt(address, args.username, args.password, port,
+                         args.timeout, args.transport, cache, metrics,
+                         retry=retry)
+
+    def host(endpoint):
+        latencies = []
+        errors = 0
+        a = connect(*endpoint)
+        try:
+            for i in range(-args.warmup, args.ops):
+                if args.reconnect and i > -args.warmup:
+                    a.close()
+                    a = connect(*endpoint)
+                start = time.perf_counter()
+                try:
+                    op(a, i)
+                except amt_error:
+                    errors += i >= 0
+                    continue
+                if i >= 0:
+                    latencies.append(time.perf_counter() - start)
+        finally:
+            a.close()
+        return latencies, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for latencies, errors in executor.map(host, endpoints):
+            result.latencies.extend(latencies)
+            result.errors += errors
+    result.elapsed = time.perf_counter() - start
+    return result
+
+def start_mock(args):
+    """Start wsman_amt.mock for args.hosts hosts; returns the process"""
+    cmd = [sys.executable, '-m', 'wsman_amt.mock', '--port', str(args.port),
+           '--hosts', str(args.hosts), '-U', args.username, '-P', args.password,
+           '--latency', str(args.latency), '--jitter', str(args.jitter),
+           '--fault-rate', str(args.fault_rate), '--drop-rate', str(args.drop_rate),
+           '--busy-rate', str(args.busy_rate), '--events', str(args.events)]
+    mock = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    line = mock.stdout.readline()
+    if not line.startswith('Serving'):
+        mock.kill()
+        raise OSError(f'mock endpoint did not start: {line.strip()}')
+    return mock
+
+def stop_mock(mock):
+    """Stop the mock endpoint; returns its statistics line"""
+    mock.send_signal(signal.SIGINT)
+    try:
+        out, _ = mock.communicate(timeout=5)
+    except subprocess.TimeoutExpired:
+        mock.kill()
+        out, _ = mock.communicate()
+    return out.strip()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark wsman_amt operations')
+    parser.add_argument('--op', choices=sorted(bench_op_map), default='status',
+                        help='Operation to run, default status')
+    parser.add_argument('--scenario', choices=['single', 'fleet', 'all'],
+                        default='all',
+                        help='Run against one host, the fleet or both, default all')
+    parser.add_argument('-n', '--ops', metavar='N', type=int, default=200,
+                        help='Operations per host, default 200')
+    parser.add_argument('--warmup', metavar='N', type=int, default=1,
+                        help='Unmeasured operations per host before, default 1')
+    parser.add_argument('--hosts', metavar='N', type=int, default=16,
+                        help='Hosts of the fleet scenario, default 16')
+    parser.add_argument('-c', '--concurrency', metavar='N', type=int, default=8,
+                        help='Hosts run in parallel in the fleet scenario, default 8')
+    parser.add_argument('--reconnect', action='store_true',
+                        help='Open a new session for each operation')
+    parser.add_argument('-T', '--transport', choices=['pywsman', 'async'],
+                        default=default_transport,
+                        help=f'WS-Man transport, default {default_transport}')
+    parser.add_argument('--cache-ttl', metavar='SECONDS', type=float, default=0,
+                        help='Use a status cache of this many seconds')
+    parser.add_argument('--retries', metavar='N', type=int, default=0,
+                        help='Retry failed requests up to N times, default 0')
+    parser.add_argument('--backoff', metavar='SECONDS', type=float, default=0.1,
+                        help='Wait before the first retry, default 0.1')
+    parser.add_argument('-t', '--timeout', type=float, default=10,
+                        help='Request timeout in seconds, default 10')
+    parser.add_argument('--target', metavar='ADDRESS',
+                        help='Benchmark a running endpoint instead of a mock, '
+                             'hosts on consecutive ports from --port')
+    parser.add_argument('-p', '--port', type=int, default=16992,
+                        help='Port of the first host, default 16992')
+    parser.add_argument('-U', '--username', default='admin')
+    parser.add_argument('-P', '--password', default='secret')
+    mock_args = parser.add_argument_group('mock endpoint')
+    mock_args.add_argument('--latency', metavar='MS', type=float, default=0,
+                           help='Delay of each request in milliseconds')
+    mock_args.add_argument('--jitter', metavar='MS', type=float, default=0,
+                           help='Additional random delay up to MS milliseconds')
+    mock_args.add_argument('--fault-rate', metavar='P', type=float, default=0,
+                           help='Fraction of requests answered with a SOAP fault')
+    mock_args.add_argument('--drop-rate', metavar='P', type=float, default=0,
+                           help='Fraction of requests whose connection is closed')
+    mock_args.add_argument('--busy-rate', metavar='P', type=float, default=0,
+                           help='Fraction of state changes refused as busy')
+    mock_args.add_argument('--events', metavar='N', type=int, default=100,
+                           help='Event log entries for --op enumerate, default 100')
+    parser.add_argument('--metrics-summary', action='store_true',
+                        help='Print per-phase request statistics of the runs')
+    parser.add_argument('-f', '--format', choices=['text', 'json'], default='text',
+                        help='Output format, default text')
+    args = parser.parse_args()
+
+    mock = None
+    address = args.target
+    if address is None:
+        address = '127.0.0.1'
+        try:
+            mock = start_mock(args)
+        except OSError as e:
+            print(e)
+            sys.exit(1)
+    results = []
+    metrics = wsman_metrics() if args.metrics_summary else None
+    try:
+        if args.scenario in ('single', 'all'):
+            results.append(run_bench('single', [(address, args.port)], 1, args,
+                                     metrics))
+        if args.scenario in ('fleet', 'all'):
+            endpoints = [(address, args.port + i) for i in range(args.hosts)]
+            results.append(run_bench('fleet', endpoints, args.concurrency, args,
+                                     metrics))
+    finally:
+        stats = stop_mock(mock) if mock is not None else None
+    if args.format == 'json':
+        print(json.dumps({ 'op': args.op, 'transport': args.transport,
+                           'cache_ttl': args.cache_ttl, 'reconnect': args.reconnect,
+                           'retries': args.retries,
+                           'results': [r.as_dict() for r in results],
+                           'mock': stats }))
+        return
+    print(f'{args.op} over {args.transport}' +
+          (f', cache {args.cache_ttl}s' if args.cache_ttl > 0 else '') +
+          (', reconnecting' if args.reconnect else ''))
+    for r in results:
+        print(r)
+    if stats:
+        print(f'mock: {stats}')
+    if metrics is not None:
+        print(metrics.summary())
+
+if __name__ == '__main__':
+    main()
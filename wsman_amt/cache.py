@@ -0,0 +1,74 @@
+"""Cache of fetched WS-Man resource documents"""
+
+import json
+import os
+import threading
+import time
+
+from .soap import XML_NS_CIM_CLASS
+
+class wsman_cache:
+    """Cache of fetched resource documents
+
+    Documents are stored as XML text keyed by endpoint and resource
+    URI and expire after 'ttl' seconds. With 'path' the cache is kept
+    in a JSON file across invocations. A single cache can be shared by
+    the sessions of many hosts.
+    """
+
+    # Resources whose state changes when another resource is modified
+    related = {
+        XML_NS_CIM_CLASS + '/CIM_PowerManagementService':
+        [XML_NS_CIM_CLASS + '/CIM_AssociatedPowerManagementService'],
+    }
+
+    def __init__(self, ttl, path=None):
+        self.ttl = ttl
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if path is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            # Corrupted cache file, start afresh
+            self.entries = {}
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            now = time.time()
+            entries = {}
+            for endpoint, docs in self.entries.items():
+                docs = {uri: e for uri, e in docs.items()
+                        if now - e[0] < self.ttl}
+                if docs:
+                    entries[endpoint] = docs
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
+
+    def get(self, endpoint, uri):
+        with self.lock:
+            e = self.entries.get(endpoint, {}).get(uri)
+        if e is None or time.time() - e[0] >= self.ttl:
+            return None
+        return e[1]
+
+    def put(self, endpoint, uri, xml):
+        with self.lock:
+            self.entries.setdefault(endpoint, {})[uri] = [time.time(), xml]
+
+    def invalidate(self, endpoint, uri):
+        with self.lock:
+            docs = self.entries.get(endpoint, {})
+            for u in [uri] + self.related.get(uri, []):
+                docs.pop(u, None)
@@ -0,0 +1,398 @@
+"""Command line interface of wsman-amt"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from .errors import amt_error
+from .fleet import fleet_job, run_host, run_fleet, read_hosts, \
+    cache_from_args, host_scheduler_from_args, retry_from_args, \
+    metrics_from_args, report_metrics, capture_fleet, mount_fleet, \
+    proxy_fleet, redirection_enabled, record_writer
+from .reconcile import load_desired_state
+from .results import enumeration_result
+from .session import default_transport
+from .sol import sol_connect, sol_attach
+
+def arg_identify(a, args):
+    return a.identify()
+
+def arg_status(a, args):
+    return a.get_status(args.all)
+
+def arg_reconcile(a, args):
+    desired = args.desired.get(a.ipaddress)
+    if desired is None:
+        raise ValueError(f'No desired state for {a.ipaddress}')
+    return a.reconcile(desired)
+
+def arg_enumerate(a, args):
+    # Instances go out as they come in, in any format
+    count = 0
+    for instance in a.enumerate(args.resource, args.max_elements):
+        if args.format == 'text':
+            print(instance, file=a.out)
+        else:
+            args.writer.instance(a.ipaddress, instance)
+        count += 1
+    return enumeration_result(args.resource, count)
+
+def arg_power(a, args):
+    if args.action == 'status':
+        return a.get_powerstate()
+    else:
+        return a.set_powerstate(args.action, args.wait)
+
+def arg_serial(a, args):
+    if args.action == 'status':
+        return a.get_redirection()
+    else:
+        return a.set_redirection(args.action, None)
+
+def serial_attach(args):
+    """Connect the terminal to the SOL console of args.host"""
+    def sink(data):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    async def attach():
+        await asyncio.to_thread(redirection_enabled, args.host, args, 'sol')
+        protocol = await sol_connect(args.host, args.username, args.password,
+                                     sink, args.tls, args.timeout)
+        print(f'Connected to {args.host}, press Ctrl-] to detach',
+              file=sys.stderr)
+        await sol_attach(protocol)
+
+    try:
+        asyncio.run(attach())
+    except amt_error as e:
+        print(f'failed: {e}')
+        return False
+    return True
+
+def serial_console(parser, args):
+    if args.action == 'attach':
+        if not args.host:
+            parser.error('serial attach requires -H/--host')
+        if not serial_attach(args):
+            sys.exit(1)
+        return
+    if args.host:
+        hosts = {args.host: None}
+    else:
+        hosts = read_hosts(args)
+    if len(hosts) > 1 and not args.output:
+        parser.error('serial capture of several hosts requires --output')
+    if not capture_fleet(hosts, args):
+        sys.exit(1)
+
+def ider_mount(parser, args):
+    if not args.image:
+        parser.error('ider mount requires an image')
+    if args.host:
+        hosts = {args.host: None}
+    else:
+        hosts = read_hosts(args)
+    try:
+        ok = mount_fleet(hosts, args)
+    except (OSError, ValueError) as e:
+        print(f'Cannot open {args.image}: {e}')
+        sys.exit(1)
+    if not ok:
+        sys.exit(1)
+
+def kvm_proxy_hosts(parser, args):
+    if args.host:
+        hosts = {args.host: None}
+    else:
+        hosts = read_hosts(args)
+    if not proxy_fleet(hosts, args):
+        sys.exit(1)
+
+def arg_ider(a, args):
+    if args.action == 'status':
+        return a.get_redirection()
+    else:
+        return a.set_redirection(None, args.action)
+
+def arg_listener(a, args):
+    if args.action == 'status':
+        return a.get_redirection()
+    else:
+        return a.set_redirection_listener(args.action)
+
+def arg_kvm(a, args):
+    if args.action == 'start':
+        return a.start_kvm_redirection()
+    else:
+        return a.kvm_redirection(args.action)
+
+def serve_api(parser, args):
+    # Only the server needs http.server
+    from .server import serve
+    try:
+        serve(args)
+    except (OSError, ValueError) as e:
+        print(f'Cannot serve on {args.socket or args.listen}: {e}')
+        sys.exit(1)
+
+def run_command(parser, args):
+    if args.func is serve_api:
+        return serve_api(parser, args)
+    if args.func is arg_serial and args.action in ('attach', 'capture'):
+        return serial_console(parser, args)
+    if args.func is arg_ider and args.action == 'mount':
+        return ider_mount(parser, args)
+    if args.func is arg_kvm and args.action == 'proxy':
+        return kvm_proxy_hosts(parser, args)
+    if args.host:
+        job = fleet_job(args.host)
+        if args.format == 'text':
+            job.output = sys.stdout
+        if args.func is arg_enumerate and args.format != 'text':
+            # The instances come first, in the same records as for
+            # fleets
+            args.writer = record_writer(args.format)
+        run_host(job, args)
+        if args.cache is not None:
+            args.cache.save()
+        if args.func is arg_enumerate and args.format != 'text':
+            args.writer.write(job)
+            args.writer.close()
+        elif args.format != 'text':
+            print(json.dumps(job.record()))
+        elif job.error is not None:
+            print(f'{job.status}: {job.error}')
+        if job.status != 'ok':
+            sys.exit(1)
+        return
+    if args.hosts or args.hosts_file:
+        hosts = read_hosts(args)
+    else:
+        hosts = dict.fromkeys(args.desired)
+    if not hosts:
+        print('No hosts specified')
+        sys.exit(1)
+    ok = run_fleet(hosts, args)
+    if args.cache is not None:
+        args.cache.save()
+    if not ok:
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    hosts = parser.add_mutually_exclusive_group()
+    hosts.add_argument('-H', '--host', help='AMT host address')
+    hosts.add_argument('--hosts', help='Comma-separated list of AMT hosts')
+    hosts.add_argument('--hosts-file',
+                       help='File with one AMT host per line')
+    parser.add_argument('-U', '--username', help='AMT username', required=True)
+    parser.add_argument('-P', '--password', help='AMT password', required=True)
+    parser.add_argument('-p', '--port', help='AMT port, default 16992',
+                        type=int, default=16992)
+    parser.add_argument('-d', '--debug', help='Enable debugging',
+                        action='count', default=0)
+    parser.add_argument('-c', '--concurrency',
+                        help='Number of hosts to run in parallel, default 32',
+                        type=int, default=32)
+    parser.add_argument('--group-concurrency', metavar='N',
+                        help='Run at most N hosts of the same group in parallel',
+                        type=int)
+    parser.add_argument('--rate', metavar='OPS',
+                        help='Start at most OPS hosts per second',
+                        type=float)
+    parser.add_argument('--burst', metavar='N',
+                        help='Allow bursts of N starts above --rate, default 1',
+                        type=int, default=1)
+    parser.add_argument('--stagger', metavar='SECONDS',
+                        help='Delay between starts within the same group',
+                        type=float)
+    parser.add_argument('--host-concurrency', metavar='N',
+                        help='Run at most N requests against the same host at a time, default 2',
+                        type=int, default=2)
+    parser.add_argument('--retries', metavar='N',
+                        help='Retry requests which failed to connect or found the firmware busy up to N times, default 2',
+                        type=int, default=2)
+    parser.add_argument('--backoff', metavar='SECONDS',
+                        help='Wait before the first retry, doubled for each further one, default 1',
+                        type=float, default=1)
+    parser.add_argument('--max-backoff', metavar='SECONDS',
+                        help='Wait at most SECONDS between retries, default 30',
+                        type=float, default=30)
+    parser.add_argument('--breaker-failures', metavar='N',
+                        help='Skip hosts after N requests without response, default 3, 0 never',
+                        type=int, default=3)
+    parser.add_argument('--breaker-cooldown', metavar='SECONDS',
+                        help='Try skipped hosts again after SECONDS, default 60',
+                        type=float, default=60)
+    parser.add_argument('-t', '--timeout',
+                        help='Request timeout in seconds, default 60',
+                        type=float, default=60)
+    parser.add_argument('--host-timeout', metavar='SECONDS',
+                        help='Give up on a host after SECONDS, default from --timeout, --retries and --backoff',
+                        type=float)
+    parser.add_argument('-T', '--transport',
+                        help=f'WS-Man transport, default {default_transport}',
+                        choices=['pywsman', 'async'],
+                        default=default_transport)
+    parser.add_argument('--cache-ttl',
+                        help='Serve status reads from a cache of this many seconds, default 0 (off)',
+                        type=float, default=0)
+    parser.add_argument('--cache-file',
+                        help='Keep the status cache in this file across invocations')
+    parser.add_argument('-f', '--format',
+                        help='Output format, default text',
+                        choices=['text', 'json', 'ndjson'], default='text')
+    parser.add_argument('--metrics-listen', metavar='[ADDRESS:]PORT',
+                        help='Serve request statistics as OpenMetrics on http://ADDRESS:PORT/metrics')
+    parser.add_argument('--metrics-file', metavar='FILE',
+                        help='Write request statistics as OpenMetrics to FILE at the end')
+    parser.add_argument('--metrics-summary', action='store_true',
+                        help='Print request statistics to stderr at the end')
+    subparsers = parser.add_subparsers()
+    parser_identify = subparsers.add_parser('identify',
+                                            help='identify AMT firmware')
+    parser_identify.add_argument('detail', help='Firmware details',
+                                 action='store_true')
+    parser_identify.set_defaults(func=arg_identify)
+    parser_status = subparsers.add_parser('status',
+                                          help='Show power and redirection state')
+    parser_status.add_argument('-a', '--all', action='store_true',
+                               help='Include firmware identity and KVM settings')
+    parser_status.set_defaults(func=arg_status)
+    parser_reconcile = subparsers.add_parser('reconcile',
+                                             help='Apply desired state from a JSON/YAML file')
+    parser_reconcile.add_argument('config', help='Desired state file')
+    parser_reconcile.set_defaults(func=arg_reconcile)
+    parser_enumerate = subparsers.add_parser('enumerate',
+                                             help='List all instances of a class')
+    parser_enumerate.add_argument('resource',
+                                  help='Class name such as AMT_EventLogEntry, or resource URI')
+    parser_enumerate.add_argument('-m', '--max-elements', metavar='N',
+                                  help='Instances per Pull request, default 32',
+                                  type=int, default=32)
+    parser_enumerate.set_defaults(func=arg_enumerate)
+    parser_power = subparsers.add_parser('power',
+                                         help='Commands for controlling power state')
+    parser_power.add_argument('action', help='AMT Power action',
+                              choices=['status','on', 'off', 'reset',
+                                       'soft-off', 'soft-reset', 'nmi',
+                                       'bus-reset', 'graceful-bus-reset',
+                                       'graceful-off', 'graceful-reset',
+                                       'graceful-soft-off',
+                                       'graceful-soft-reset',
+                                       'hibernate', 'sleep', 'deep-sleep'])
+    parser_power.add_argument('-w', '--wait', metavar='SECONDS',
+                              help='Wait for the new power state, up to 300 seconds or SECONDS',
+                              type=float, nargs='?', const=300)
+    parser_power.set_defaults(func=arg_power)
+    parser_serial = subparsers.add_parser('serial',
+                                          help='Commands for controlling serial redirection')
+    parser_serial.add_argument('action', help='AMT serial redirection action',
+                               choices=['status','enable','disable',
+                                        'attach','capture'])
+    parser_serial.add_argument('-o', '--output', metavar='DIR',
+                               help='capture: write <host>.log files in DIR instead of stdout')
+    parser_serial.add_argument('--max-bytes', metavar='N',
+                               help='capture: rotate files at N bytes, default 16 MiB, 0 never',
+                               type=int, default=16 << 20)
+    parser_serial.add_argument('--backups', metavar='N',
+                               help='capture: keep N rotated files, default 5',
+                               type=int, default=5)
+    parser_serial.add_argument('--duration', metavar='SECONDS',
+                               help='capture: stop after SECONDS',
+                               type=float)
+    parser_serial.add_argument('--tls', action='store_true',
+                               help='attach/capture: use TLS on port 16995')
+    parser_serial.set_defaults(func=arg_serial)
+    parser_listener = subparsers.add_parser('listener',
+                                          help='Commands for controlling redirection listener')
+    parser_listener.add_argument('action', help='AMT redirection listener action',
+                               choices=['status','enable','disable'])
+    parser_listener.set_defaults(func=arg_listener)
+    parser_ider = subparsers.add_parser('ider',
+                                          help='Commands for controlling IDE redirection')
+    parser_ider.add_argument('action', help='AMT IDE redirection action',
+                             choices=['status','enable','disable','mount'])
+    parser_ider.add_argument('image', nargs='?',
+                             help='mount: CD image to serve')
+    parser_ider.add_argument('--now', action='store_true',
+                             help='mount: attach the drive right away instead of on the next reboot')
+    parser_ider.add_argument('--duration', metavar='SECONDS',
+                             help='mount: stop serving after SECONDS',
+                             type=float)
+    parser_ider.add_argument('--tls', action='store_true',
+                             help='mount: use TLS on port 16995')
+    parser_ider.set_defaults(func=arg_ider)
+    parser_kvm = subparsers.add_parser('kvm',
+                                       help='Commands for controlling KVM redirection')
+    parser_kvm.add_argument('action', help='AMT KVM redirection action',
+                             choices=['status','enable','disable','start',
+                                      'proxy'])
+    parser_kvm.add_argument('--listen', metavar='ADDRESS',
+                            help='proxy: address to accept viewers on, default 127.0.0.1',
+                            default='127.0.0.1')
+    parser_kvm.add_argument('--listen-port', metavar='PORT',
+                            help='proxy: port for the first host, one more for each further host, default 5900',
+                            type=int, default=5900)
+    parser_kvm.add_argument('--idle', metavar='SECONDS',
+                            help='proxy: close the KVM session SECONDS after the last viewer left, default 60',
+                            type=float, default=60)
+    parser_kvm.add_argument('--cache-mb', metavar='MB',
+                            help='proxy: screen updates kept for new viewers per host, default 16',
+                            type=int, default=16)
+    parser_kvm.add_argument('--view-only', action='store_true',
+                            help='proxy: do not pass on keyboard and mouse input')
+    parser_kvm.add_argument('--duration', metavar='SECONDS',
+                            help='proxy: stop after SECONDS',
+                            type=float)
+    parser_kvm.set_defaults(func=arg_kvm)
+    parser_serve = subparsers.add_parser('serve',
+                                         help='Answer HTTP/JSON requests, keeping sessions open')
+    parser_serve.add_argument('--listen', metavar='[ADDRESS:]PORT',
+                              help='Address and port to accept requests on, default 127.0.0.1:16990',
+                              default='127.0.0.1:16990')
+    parser_serve.add_argument('--socket', metavar='PATH',
+                              help='Accept requests on this Unix socket instead')
+    parser_serve.add_argument('--max-hosts', metavar='N',
+                              help='Keep sessions to at most N hosts open, default 64',
+                              type=int, default=64)
+    parser_serve.add_argument('--idle', metavar='SECONDS',
+                              help='Close sessions unused for SECONDS, default 300',
+                              type=float, default=300)
+    parser_serve.set_defaults(func=serve_api)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        print("No command specified, must be one of 'identify,status,reconcile,enumerate,power,serial,listener,ider,kvm,serve'")
+        return
+    if args.func is arg_reconcile:
+        try:
+            args.desired = load_desired_state(args.config)
+        except (OSError, ValueError) as e:
+            print(f'Cannot load {args.config}: {e}')
+            sys.exit(1)
+    elif args.func is not serve_api and \
+         not (args.host or args.hosts or args.hosts_file):
+        parser.error('one of the arguments -H/--host --hosts --hosts-file is required')
+    if args.cache_file and args.cache_ttl <= 0:
+        parser.error('--cache-file requires --cache-ttl')
+    args.cache = cache_from_args(args)
+    args.scheduler = host_scheduler_from_args(args)
+    args.retry = retry_from_args(args)
+    try:
+        args.metrics = metrics_from_args(args)
+    except (OSError, ValueError) as e:
+        print(f'Cannot serve metrics on {args.metrics_listen}: {e}')
+        sys.exit(1)
+    try:
+        run_command(parser, args)
+    except BrokenPipeError:
+        # Output piped into head and the like; keep the interpreter
+        # from failing again when it flushes stdout on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    finally:
+        report_metrics(args)
@@ -0,0 +1,59 @@
+"""Exceptions raised by wsman_amt
+
+Each class names the kind of failure in 'kind', as reported for
+fleet runs.
+"""
+
+class amt_error(Exception):
+    """Base class of the errors raised by wsman_amt"""
+
+    kind = 'error'
+
+class amt_connection_error(amt_error):
+    """The endpoint could not be reached or did not respond"""
+
+    kind = 'connection'
+
+class amt_connect_error(amt_connection_error):
+    """No connection to the endpoint could be established, so the
+    request was not sent"""
+
+    kind = 'connect'
+
+class amt_timeout_error(amt_connection_error):
+    """The endpoint did not respond in time"""
+
+    kind = 'timeout'
+
+class amt_unavailable_error(amt_connection_error):
+    """Requests to the endpoint are skipped after repeated failures"""
+
+    kind = 'unavailable'
+
+class amt_auth_error(amt_error):
+    """The endpoint rejected the credentials"""
+
+    kind = 'auth'
+
+class amt_busy_error(amt_error):
+    """The firmware was busy (ReturnValue 4099) and did not carry out
+    the request"""
+
+    kind = 'busy'
+
+class amt_response_error(amt_error):
+    """The endpoint sent a response which cannot be interpreted"""
+
+    kind = 'response'
+
+class amt_fault(amt_error):
+    """The endpoint answered with a SOAP fault"""
+
+    kind = 'fault'
+
+    def __init__(self, resource, fault):
+        self.resource = resource
+        self.reason = fault.reason()
+        self.code = fault.code()
+        self.subcode = fault.subcode()
+        super().__init__(f'{resource} failed: {self.reason}')
@@ -0,0 +1,446 @@
+"""Run a wsman_amt operation against a fleet of hosts"""
+
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .amt import wsman_amt
+from .cache import wsman_cache
+from .errors import amt_error
+from .retry import retry_policy, circuit_breaker
+from .schedule import rolling_scheduler, host_scheduler
+from .ider import shared_image, ider_connect
+from .kvm import kvm_proxy
+from .redirect import redirection_wait
+from .sol import rotating_file, sol_connect
+
+class fleet_job:
+    """Result of running one subcommand against one host of a fleet"""
+
+    def __init__(self, host, group=None):
+        self.host = host
+        self.group = group
+        self.output = io.StringIO()
+        self.started = None
+        self.elapsed = None
+        self.status = 'pending'
+        self.result = None
+        self.error = None
+        self.error_kind = None
+        self.amt = None
+
+    def report(self, file=None):
+        lines = self.output.getvalue().splitlines()
+        if self.error is not None:
+            lines.append(f'{self.status}: {self.error}')
+        for line in lines:
+            print(f'{self.host}: {line}', file=file)
+
+    def record(self):
+        return { 'host': self.host, 'group': self.group,
+                 'status': self.status,
+                 'elapsed': self.elapsed,
+                 'result': self.result.as_dict() if self.result else None,
+                 'messages': self.output.getvalue().splitlines(),
+                 'error': self.error,
+                 'error_kind': self.error_kind }
+
+class record_writer:
+    """Write completed fleet jobs to stdout as prefixed text lines,
+    as a JSON array or as one JSON object per line, each as soon as
+    it is passed in. For JSON, instance() writes records of single
+    instances from worker threads in between; those passed in after
+    close() are dropped."""
+
+    def __init__(self, format, file=None):
+        self.format = format
+        self.file = file
+        self.count = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        if self.format == 'ndjson':
+            print(json.dumps(record), file=self.file, flush=True)
+        else:
+            sep = ',' if self.count else '['
+            print(sep + json.dumps(record), file=self.file, flush=True)
+        self.count += 1
+
+    def write(self, job):
+        with self.lock:
+            if self.format == 'text':
+                job.report(self.file)
+            else:
+                self.emit(job.record())
+
+    def instance(self, host, result):
+        """Write the instance_result 'result' of 'host'"""
+        with self.lock:
+            if not self.closed:
+                self.emit({ 'host': host, 'resource': result.name,
+                            'instance': result.properties })
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.format == 'json':
+                print(']' if self.count else '[]', file=self.file)
+
+def read_hosts(args):
+    """Return the hosts from the command line and hosts file, mapped to
+    their group; lines of the hosts file may name the group (a rack or
+    PDU label) after the host"""
+    hosts = []
+    if args.hosts:
+        hosts.extend((h, None) for h in args.hosts.split(','))
+    if args.hosts_file:
+        with open(args.hosts_file) as f:
+            for line in f:
+                fields = line.split('#', 1)[0].split()
+                if fields:
+                    hosts.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return dict((h.strip(), g) for h, g in hosts if h.strip())
+
+def cache_from_args(args):
+    if args.cache_ttl <= 0:
+        return None
+    return wsman_cache(args.cache_ttl, args.cache_file)
+
+def host_scheduler_from_args(args):
+    return host_scheduler(args.host_concurrency)
+
+def retry_from_args(args):
+    breaker = None
+    if args.breaker_failures > 0:
+        breaker = circuit_breaker(args.breaker_failures, args.breaker_cooldown)
+    return retry_policy(args.retries + 1, args.backoff, args.max_backoff,
+                        breaker)
+
+def metrics_from_args(args):
+    """Return a wsman_metrics if any metrics output is requested,
+    serving it right away with --metrics-listen"""
+    if not (args.metrics_listen or args.metrics_file or args.metrics_summary):
+        return None
+    from .metrics import wsman_metrics
+    metrics = wsman_metrics()
+    if args.metrics_listen:
+        address, _, port = args.metrics_listen.rpartition(':')
+        metrics.serve(address or '127.0.0.1', int(port))
+    return metrics
+
+def report_metrics(args):
+    """Write the statistics of the run as requested"""
+    if args.metrics is None:
+        return
+    if args.metrics_file:
+        args.metrics.save(args.metrics_file)
+    if args.metrics_summary:
+        summary = args.metrics.summary()
+        if summary:
+            print(summary, file=sys.stderr)
+
+def run_host(job, args):
+    job.started = time.monotonic()
+    job.status = 'running'
+    result = error = error_kind = None
+    try:
+        with wsman_amt(job.host, args.username, args.password,
+                       args.port, args.timeout, args.transport,
+                       args.cache, args.metrics, args.scheduler,
+                       args.retry) as a:
+            job.amt = a
+            a.out = job.output
+            a.debug(args.debug)
+            result = args.func(a, args)
+            if result is not None and args.format == 'text':
+                print(result, file=job.output)
+            status = 'ok' if result is not None and result.ok else 'failed'
+    except (amt_error, ValueError) as e:
+        status = 'failed'
+        error = str(e)
+        error_kind = getattr(e, 'kind', 'invalid')
+    except Exception as e:
+        status = 'failed'
+        error = repr(e)
+    if job.status == 'timeout':
+        # Given up on and reported already
+        return job
+    job.result = result
+    job.status = status
+    job.error = error
+    job.error_kind = error_kind
+    job.elapsed = time.monotonic() - job.started
+    return job
+
+# Requests made by the longer operations, like changing a setting
+# or reconcile
+host_requests = 4
+
+def scheduler_from_args(args):
+    return rolling_scheduler(args.concurrency, args.group_concurrency,
+                             args.rate, args.burst, args.stagger)
+
+def host_deadline(args):
+    """Seconds after which a host is reported as timed out: those of
+    --host-timeout, or as long as the requests of an operation may
+    take with retries, plus waiting for power state changes"""
+    if args.host_timeout:
+        return args.host_timeout
+    return args.retry.deadline(args.timeout, host_requests) + \
+        (getattr(args, 'wait', None) or 0)
+
+def run_fleet(hosts, args):
+    """Run the selected subcommand against all hosts, a mapping of host
+    to group, with a bounded worker pool, reporting each host as soon
+    as it completes. Jobs are started round-robin across groups as the
+    scheduler admits them."""
+    jobs = [fleet_job(h, g) for h, g in hosts.items()]
+    writer = args.writer = record_writer(args.format)
+    executor = ThreadPoolExecutor(max_workers=args.concurrency)
+    scheduler = scheduler_from_args(args)
+    queues = {}
+    for job in jobs:
+        queues.setdefault(job.group, deque()).append(job)
+    pending = {}
+
+    def dispatch():
+        """Start what the scheduler allows; returns the time until
+        the next start is due"""
+        next_start = 0.1
+        started = True
+        while started:
+            started = False
+            for group, queue in list(queues.items()):
+                delay = scheduler.delay(group)
+                if delay is None:
+                    continue
+                if delay > 0:
+                    next_start = min(next_start, delay)
+                    continue
+                job = queue.popleft()
+                if not queue:
+                    del queues[group]
+                scheduler.start(group)
+                f = executor.submit(run_host, job, args)
+                f.add_done_callback(lambda f, g=group: scheduler.finish(g))
+                pending[f] = job
+                started = True
+        return next_start
+
+    limit = host_deadline(args)
+    while pending or queues:
+        next_start = dispatch()
+        if not pending:
+            time.sleep(next_start)
+            continue
+        done, _ = wait(pending, timeout=next_start,
+                       return_when=FIRST_COMPLETED)
+        for f in done:
+            writer.write(pending.pop(f))
+        now = time.monotonic()
+        for f, job in list(pending.items()):
+            if job.started is not None and now - job.started > limit:
+                job.status = 'timeout'
+                job.error = f'no result after {limit:g}s'
+                del pending[f]
+                writer.write(job)
+                # The worker thread cannot be interrupted, but its
+                # requests can, so that it ends
+                if job.amt is not None:
+                    job.amt.abort()
+    executor.shutdown(wait=False, cancel_futures=True)
+    writer.close()
+    return report_summary(jobs, args)
+
+def report_summary(jobs, args, file=None):
+    """Print how many jobs succeeded; returns whether all did"""
+    ok = len([j for j in jobs if j.status == 'ok'])
+    failed = len([j for j in jobs if j.status == 'failed'])
+    timeout = len([j for j in jobs if j.status == 'timeout'])
+    # Keep machine-readable output parseable
+    if file is None:
+        file = sys.stdout if args.format == 'text' else sys.stderr
+    print(f'{len(jobs)} hosts: {ok} ok, {failed} failed, {timeout} timed out',
+          file=file)
+    if ok < len(jobs):
+        print('Failed hosts: ' + ' '.join(j.host for j in jobs if j.status != 'ok'),
+              file=file)
+    kinds = {}
+    for j in jobs:
+        if j.error_kind is not None:
+            kinds[j.error_kind] = kinds.get(j.error_kind, 0) + 1
+    if kinds:
+        print('Errors: ' + ', '.join(f'{k} {n}' for k, n in sorted(kinds.items())),
+              file=file)
+    return ok == len(jobs)
+
+def redirection_enabled(host, args, feature):
+    """Raise amt_error unless 'feature', 'sol' or 'ider', and the
+    redirection listener are enabled on 'host'"""
+    with wsman_amt(host, args.username, args.password, args.port,
+                   args.timeout, args.transport, args.cache, args.metrics,
+                   args.scheduler, args.retry) as a:
+        r = a.get_redirection(cached=False)
+    if not getattr(r, feature) or not r.listener:
+        raise amt_error(f'{feature.upper()} redirection is not enabled: {r}')
+
+async def run_session(job, args, setup, writer, session):
+    """Run the redirection 'session' coroutine for one host; it sets
+    job.status to 'connected' once the session is established, after
+    which an interruption counts as success"""
+    job.started = time.monotonic()
+    job.status = 'running'
+    try:
+        await session(job, args, setup)
+        job.status = 'ok'
+    except (amt_error, OSError) as e:
+        job.status = 'failed'
+        job.error = str(e)
+        job.error_kind = getattr(e, 'kind', 'connection')
+    except asyncio.CancelledError:
+        if job.status == 'connected':
+            job.status = 'ok'
+        else:
+            job.status = 'failed'
+            job.error = 'interrupted'
+        raise
+    finally:
+        job.elapsed = time.monotonic() - job.started
+        writer.write(job)
+
+def run_sessions(hosts, args, session, file=None):
+    """Run redirection sessions for all hosts from one event loop until
+    they end, args.duration passes or the user interrupts. Sessions
+    are set up args.concurrency at a time."""
+    jobs = [fleet_job(h, g) for h, g in hosts.items()]
+    writer = record_writer(args.format, file)
+
+    async def run():
+        setup = asyncio.Semaphore(args.concurrency)
+        await asyncio.gather(*(run_session(job, args, setup, writer, session)
+                               for job in jobs))
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    writer.close()
+    return report_summary(jobs, args, file)
+
+async def capture_host(job, args, setup):
+    log = None
+    received = 0
+    path = 'stdout'
+
+    def sink(data):
+        nonlocal received
+        received += len(data)
+        if log is not None:
+            log.write(data)
+        else:
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+
+    try:
+        if args.output:
+            path = os.path.join(args.output, job.host + '.log')
+            log = rotating_file(path, args.max_bytes, args.backups)
+        async with setup:
+            await asyncio.to_thread(redirection_enabled, job.host, args, 'sol')
+            protocol = await sol_connect(job.host, args.username,
+                                         args.password, sink, args.tls,
+                                         args.timeout)
+        job.status = 'connected'
+        await redirection_wait(protocol, args.duration)
+    finally:
+        if log is not None:
+            log.close()
+        if job.status == 'connected':
+            print(f'Captured {received} bytes to {path}', file=job.output)
+
+def capture_fleet(hosts, args):
+    """Capture the SOL consoles of all hosts, each to a rotating file
+    in args.output or, for a single host, to stdout"""
+    # Console output may go to stdout
+    file = sys.stdout if args.output else sys.stderr
+    return run_sessions(hosts, args, capture_host, file)
+
+async def mount_host(job, args, setup):
+    image = shared_image.open(args.image)
+    protocol = None
+    try:
+        async with setup:
+            await asyncio.to_thread(redirection_enabled, job.host, args, 'ider')
+            protocol = await ider_connect(job.host, args.username,
+                                          args.password, image, args.now,
+                                          args.tls, args.timeout)
+        job.status = 'connected'
+        await redirection_wait(protocol, args.duration)
+    finally:
+        if protocol is not None:
+            print(f'Served {protocol.sectors_read} sectors of {args.image}',
+                  file=job.output)
+        image.close()
+
+def mount_fleet(hosts, args):
+    """Serve args.image as a CD-ROM to all hosts from one read-only
+    mapping"""
+    # Fail early and keep the mapping for the whole run
+    image = shared_image.open(args.image)
+    try:
+        return run_sessions(hosts, args, mount_host)
+    finally:
+        image.close()
+
+def kvm_start(host, args):
+    """Raise amt_error unless KVM redirection on port 5900 is enabled
+    on 'host', then start it"""
+    with wsman_amt(host, args.username, args.password, args.port,
+                   args.timeout, args.transport, args.cache, args.metrics,
+                   args.scheduler, args.retry) as a:
+        kvm = a.kvm_redirection('status')
+        if not kvm.port_5900:
+            raise amt_error(f'KVM redirection is not enabled: {kvm}')
+        result = a.start_kvm_redirection()
+        if not result.ok:
+            raise amt_error(str(result))
+
+async def proxy_host(job, args, setup):
+    port = args.kvm_ports[job.host]
+
+    def log(msg):
+        print(f'{job.host}: {msg}', file=sys.stderr, flush=True)
+
+    async def connect():
+        await asyncio.to_thread(kvm_start, job.host, args)
+
+    proxy = kvm_proxy(job.host, args.password, connect, args.idle,
+                      args.cache_mb << 20, args.view_only, log)
+    async with setup:
+        await asyncio.to_thread(kvm_start, job.host, args)
+    server = asyncio.ensure_future(proxy.serve(args.listen, port))
+    try:
+        # Bind errors show up right away
+        await asyncio.wait_for(asyncio.shield(server), 0.1)
+    except asyncio.TimeoutError:
+        pass
+    job.status = 'connected'
+    log(f'viewers connect to {args.listen}:{port}')
+    try:
+        await asyncio.wait_for(server, args.duration)
+    except asyncio.TimeoutError:
+        pass
+    print(f'Proxied on {args.listen}:{port}', file=job.output)
+
+def proxy_fleet(hosts, args):
+    """Run a KVM proxy for each host, listening on consecutive ports
+    from args.listen_port"""
+    args.kvm_ports = {h: args.listen_port + i for i, h in enumerate(hosts)}
+    return run_sessions(hosts, args, proxy_host, sys.stderr)
@@ -0,0 +1,337 @@
+"""IDE redirection: serve a CD image to AMT hosts"""
+
+import asyncio
+import mmap
+import os
+import struct
+
+from .redirect import redirection_protocol, redirection_connect
+
+IDER_OPEN_SESSION = 0x40
+IDER_OPEN_SESSION_REPLY = 0x41
+IDER_CLOSE_SESSION = 0x43
+IDER_KEEP_ALIVE_PING = 0x44
+IDER_KEEP_ALIVE_PONG = 0x45
+IDER_RESET_OCCURRED = 0x46
+IDER_RESET_OCCURRED_RESPONSE = 0x47
+IDER_DISABLE_ENABLE_FEATURES = 0x48
+IDER_DISABLE_ENABLE_FEATURES_REPLY = 0x49
+IDER_ERROR_OCCURRED = 0x4A
+IDER_HEARTBEAT = 0x4B
+IDER_COMMAND_WRITTEN = 0x50
+IDER_COMMAND_END_RESPONSE = 0x51
+IDER_DATA_FROM_HOST = 0x53
+IDER_DATA_TO_HOST = 0x54
+
+# DISABLE_ENABLE_FEATURES register toggle: enable IDER on the next
+# reboot, gracefully, or right away
+IDER_FEATURES_TOGGLE = 3
+IDER_ENABLE_ON_REBOOT = 0x01 | 0x08
+IDER_ENABLE_NOW = 0x01 | 0x10
+
+IDER_RX_TIMEOUT = 30000
+IDER_HEARTBEAT_INTERVAL = 20
+IDER_DEVICE_CDROM = 0xB0
+
+CD_SECTOR_SIZE = 2048
+
+# SCSI sense keys
+SENSE_NOT_READY = 0x02
+SENSE_ILLEGAL_REQUEST = 0x05
+
+class shared_image:
+    """Read-only mapping of a disk image
+
+    All sessions serving the same file share one mapping, so the image
+    is neither copied nor read more than once per session; open() and
+    close() count the users. readahead() asks the kernel to page in
+    a range ahead of time.
+    """
+
+    images = {}
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            if self.size == 0:
+                raise ValueError(f'{path} is empty')
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+        self.sectors = (self.size + CD_SECTOR_SIZE - 1) // CD_SECTOR_SIZE
+        self.users = 0
+
+    @classmethod
+    def open(cls, path):
+        path = os.path.realpath(path)
+        image = cls.images.get(path)
+        if image is None:
+            image = cls.images[path] = cls(path)
+        image.users += 1
+        return image
+
+    def close(self):
+        self.users -= 1
+        if self.users == 0:
+            del self.images[self.path]
+            try:
+                self.map.close()
+            except BufferError:
+                # Views still queued in a transport; unmapped once
+                # they are released
+                pass
+
+    def read(self, offset, length):
+        """Return 'length' bytes at 'offset' as a view of the mapping,
+        zero-padding the last partial sector"""
+        view = memoryview(self.map)[offset:offset + length]
+        if len(view) == length:
+            return view
+        return bytes(view) + bytes(length - len(view))
+
+    def readahead(self, offset, length):
+        if not hasattr(mmap, 'MADV_WILLNEED') or offset >= self.size:
+            return
+        start = offset - offset % mmap.PAGESIZE
+        length = min(length + offset - start, self.size - start)
+        self.map.madvise(mmap.MADV_WILLNEED, start, length)
+
+class ider_protocol(redirection_protocol):
+    """IDE redirection session presenting 'image' as a CD-ROM
+
+    SCSI reads are served from the shared mapping of the image in
+    chunks of the host's read buffer size, waiting for the socket to
+    drain between chunks so a slow host cannot make data pile up.
+    Sequential reads open a read-ahead window which doubles up to
+    'readahead_max' bytes. With 'now' the host sees the drive right
+    away, otherwise on its next reboot.
+    """
+
+    session_type = b'IDER'
+    buffer_size = 16384
+    message_size_map = { IDER_CLOSE_SESSION: 8,
+                         IDER_KEEP_ALIVE_PING: 8,
+                         IDER_KEEP_ALIVE_PONG: 8,
+                         IDER_RESET_OCCURRED: 9,
+                         IDER_DISABLE_ENABLE_FEATURES_REPLY: 13,
+                         IDER_ERROR_OCCURRED: 11,
+                         IDER_HEARTBEAT: 8,
+                         IDER_COMMAND_WRITTEN: 28 }
+    readahead_min = 128 << 10
+    readahead_max = 4 << 20
+
+    def __init__(self, username, password, image, now=False):
+        super().__init__(username, password)
+        self.image = image
+        self.now = now
+        self.read_buffer = 8192
+        self.sense = (0, 0, 0)
+        self.media_reported = False
+        self.next_offset = None
+        self.window = self.readahead_min
+        self.sectors_read = 0
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def message_size(self, data):
+        cmd = data[0]
+        if cmd == IDER_OPEN_SESSION_REPLY:
+            return 30 + data[29] if len(data) >= 30 else None
+        if cmd == IDER_DATA_FROM_HOST:
+            return 14 + struct.unpack_from('<H', data, 9)[0] if len(data) >= 14 else None
+        return super().message_size(data)
+
+    def data_header(self, cmd):
+        # Writes to a CD are refused, their data is dropped
+        return 14 if cmd == IDER_DATA_FROM_HOST else None
+
+    def authenticated(self):
+        self.send(IDER_OPEN_SESSION, struct.pack('<HHHI', IDER_RX_TIMEOUT, 0,
+                                                 IDER_HEARTBEAT_INTERVAL * 1000, 1))
+
+    def handle(self, msg):
+        cmd = msg[0]
+        if cmd == IDER_OPEN_SESSION_REPLY:
+            read_buffer = struct.unpack_from('<H', msg, 16)[0]
+            if read_buffer:
+                self.read_buffer = min(read_buffer, 8192)
+            toggle = IDER_ENABLE_NOW if self.now else IDER_ENABLE_ON_REBOOT
+            self.send(IDER_DISABLE_ENABLE_FEATURES,
+                      struct.pack('<BI', IDER_FEATURES_TOGGLE, toggle))
+        elif cmd == IDER_DISABLE_ENABLE_FEATURES_REPLY:
+            kind, value = struct.unpack_from('<BI', msg, 8)
+            if kind == IDER_FEATURES_TOGGLE:
+                if value != 1:
+                    return self.fail(f'IDER could not be enabled, status {value}')
+                self.running()
+                self.spawn(self.keepalive())
+        elif cmd == IDER_CLOSE_SESSION:
+            self.transport.close()
+        elif cmd == IDER_KEEP_ALIVE_PING:
+            self.send(IDER_KEEP_ALIVE_PONG)
+        elif cmd == IDER_RESET_OCCURRED:
+            self.media_reported = False
+            self.send(IDER_RESET_OCCURRED_RESPONSE)
+        elif cmd == IDER_COMMAND_WRITTEN:
+            device = IDER_DEVICE_CDROM if msg[14] & 0x10 else 0xA0
+            self.spawn(self.command(device, msg[16:28], msg[9] & 1))
+        elif cmd not in (IDER_KEEP_ALIVE_PONG, IDER_ERROR_OCCURRED,
+                         IDER_HEARTBEAT):
+            super().handle(msg)
+
+    async def keepalive(self):
+        while not self.transport.is_closing():
+            await asyncio.sleep(IDER_HEARTBEAT_INTERVAL / 2)
+            self.send(IDER_HEARTBEAT)
+
+    def command_end(self, device, sense=0, asc=0, ascq=0):
+        self.sense = (sense, asc, ascq)
+        if sense:
+            registers = bytes([0x87, sense << 4, 3, 0, 0, 0, device, 0x51,
+                               sense, asc, ascq])
+        else:
+            registers = bytes([0xC5, 0, 3, 0, 0, 0, device, 0x50, 0, 0, 0])
+        self.send(IDER_COMMAND_END_RESPONSE, bytes(15) + registers, 2)
+
+    async def data_to_host(self, device, data, dma, completed=True):
+        if not self.writable.is_set():
+            await self.writable.wait()
+        length = len(data)
+        count = 0 if dma else length
+        registers = struct.pack('<xHxBxBxHBB', length, 0xB4 if dma else 0xB5,
+                                2, count, device, 0x58)
+        if completed:
+            registers += bytes([0x85, 0, 3, 0, 0, 0, 0x50]) + bytes(9)
+        else:
+            registers += bytes(16)
+        self.send(IDER_DATA_TO_HOST, registers, (2 if completed else 0) | dma)
+        self.transport.write(data)
+
+    async def command(self, device, cdb, dma):
+        op = cdb[0]
+        if device != IDER_DEVICE_CDROM:
+            # No floppy
+            return self.command_end(device, SENSE_NOT_READY, 0x3A)
+        if op in (0x00, 0x1B, 0x1E, 0x2B, 0x2F):
+            # TEST UNIT READY, START STOP, PREVENT ALLOW MEDIUM
+            # REMOVAL, SEEK, VERIFY
+            return self.command_end(device)
+        if op in (0x28, 0xA8):
+            # READ(10), READ(12)
+            lba = struct.unpack_from('>I', cdb, 2)[0]
+            if op == 0x28:
+                count = struct.unpack_from('>H', cdb, 7)[0]
+            else:
+                count = struct.unpack_from('>I', cdb, 6)[0]
+            return await self.read(device, lba, count, dma)
+        data = self.reply(cdb)
+        if data is None:
+            return self.command_end(device, SENSE_ILLEGAL_REQUEST, 0x20)
+        await self.data_to_host(device, data, dma)
+        self.sense = (0, 0, 0)
+
+    async def read(self, device, lba, count, dma):
+        if count == 0:
+            return self.command_end(device)
+        if lba + count > self.image.sectors:
+            # LOGICAL BLOCK ADDRESS OUT OF RANGE
+            return self.command_end(device, SENSE_ILLEGAL_REQUEST, 0x21)
+        offset = lba * CD_SECTOR_SIZE
+        end = offset + count * CD_SECTOR_SIZE
+        if offset == self.next_offset:
+            self.window = min(self.window * 2, self.readahead_max)
+        else:
+            self.window = self.readahead_min
+        self.next_offset = end
+        self.image.readahead(end, self.window)
+        chunk = self.read_buffer - self.read_buffer % CD_SECTOR_SIZE
+        while offset < end:
+            length = min(chunk, end - offset)
+            await self.data_to_host(device, self.image.read(offset, length), dma,
+                                    offset + length == end)
+            offset += length
+        self.sense = (0, 0, 0)
+        self.sectors_read += count
+
+    def reply(self, cdb):
+        """Return the data for a SCSI command other than READ, or None
+        if it is not supported"""
+        op = cdb[0]
+        if op == 0x12:
+            # INQUIRY
+            data = bytes([0x05, 0x80, 0x00, 0x01, 0x1F, 0, 0, 0]) + \
+                b'Intel   Virtual CD-ROM  1.00'
+            return data[:struct.unpack_from('>H', cdb, 3)[0]]
+        if op == 0x03:
+            # REQUEST SENSE
+            sense, asc, ascq = self.sense
+            data = bytes([0x70, 0, sense, 0, 0, 0, 0, 10, 0, 0, 0, 0,
+                          asc, ascq, 0, 0, 0, 0])
+            return data[:cdb[4]]
+        if op == 0x25:
+            # READ CAPACITY
+            return struct.pack('>II', self.image.sectors - 1, CD_SECTOR_SIZE)
+        if op == 0x43:
+            # READ TOC
+            return self.toc(cdb)
+        if op == 0x46:
+            # GET CONFIGURATION, current profile CD-ROM
+            data = struct.pack('>IxxH', 4, 0x0008)
+            return data[:struct.unpack_from('>H', cdb, 7)[0]]
+        if op == 0x4A and cdb[1] & 1:
+            # GET EVENT STATUS NOTIFICATION, polled: report the media
+            # as new once, then as unchanged
+            event = 0 if self.media_reported else 2
+            self.media_reported = True
+            data = bytes([0, 6, 4, 0x10, event, 2, 0, 0])
+            return data[:struct.unpack_from('>H', cdb, 7)[0]]
+        if op in (0x1A, 0x5A):
+            # MODE SENSE(6), MODE SENSE(10): no pages, write protected
+            page = cdb[2] & 0x3F
+            if page not in (0x2A, 0x3F):
+                return None
+            # CD capabilities page: reads CD-R/RW, no writing, tray
+            caps = bytes([0x2A, 0x12, 0x03, 0x00, 0x71, 0x00, 0x29, 0x00]) + bytes(12)
+            if op == 0x1A:
+                data = bytes([3 + len(caps), 0x70, 0x80, 0]) + caps
+                return data[:cdb[4]]
+            data = struct.pack('>HBBxxxx', 6 + len(caps), 0x70, 0x80) + caps
+            return data[:struct.unpack_from('>H', cdb, 7)[0]]
+        return None
+
+    def toc(self, cdb):
+        msf = cdb[1] & 0x02
+        form = cdb[2] & 0x0F or cdb[9] >> 6
+        length = struct.unpack_from('>H', cdb, 7)[0]
+
+        def address(lba):
+            if not msf:
+                return struct.pack('>I', lba)
+            lba += 150
+            return bytes([0, lba // (75 * 60), lba // 75 % 60, lba % 75])
+
+        if form == 0:
+            data = bytes([0, 18, 1, 1, 0, 0x14, 1, 0]) + address(0) + \
+                bytes([0, 0x14, 0xAA, 0]) + address(self.image.sectors)
+        elif form == 1:
+            # Session info: one session starting with track 1
+            data = bytes([0, 10, 1, 1, 0, 0x14, 1, 0]) + address(0)
+        else:
+            return None
+        return data[:length]
+
+async def ider_connect(host, username, password, image, now=False,
+                       tls=False, timeout=None):
+    """Open an IDE redirection session to 'host' serving the
+    shared_image 'image' and return its ider_protocol once the drive
+    is enabled"""
+    return await redirection_connect(lambda: ider_protocol(username, password,
+                                                           image, now),
+                                     host, tls, timeout)
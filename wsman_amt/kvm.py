@@ -0,0 +1,453 @@
+"""RFB proxy sharing one AMT KVM session between several viewers"""
+
+import asyncio
+import os
+import struct
+
+from .des import vnc_response
+from .errors import amt_error, amt_connection_error, amt_response_error
+
+KVM_PORT = 5900
+
+RFB_VERSION = b'RFB 003.008\n'
+SECURITY_NONE = 1
+SECURITY_VNC = 2
+
+# Client to server
+SET_PIXEL_FORMAT = 0
+SET_ENCODINGS = 2
+FRAMEBUFFER_UPDATE_REQUEST = 3
+KEY_EVENT = 4
+POINTER_EVENT = 5
+CLIENT_CUT_TEXT = 6
+
+# Server to client
+FRAMEBUFFER_UPDATE = 0
+SET_COLOUR_MAP_ENTRIES = 1
+BELL = 2
+SERVER_CUT_TEXT = 3
+
+ENCODING_RAW = 0
+ENCODING_COPYRECT = 1
+ENCODING_RRE = 2
+ENCODING_HEXTILE = 5
+ENCODING_DESKTOP_SIZE = -223
+
+# Updates are passed on as received, so every viewer has to be able
+# to decode them: one true-colour format and only encodings which do
+# not depend on earlier updates, unlike the zlib based ones
+PIXEL_FORMAT = struct.pack('>BBBBHHHBBBxxx', 32, 24, 0, 1, 255, 255, 255,
+                           16, 8, 0)
+BYTES_PER_PIXEL = 4
+ENCODINGS = [ENCODING_HEXTILE, ENCODING_RRE, ENCODING_COPYRECT,
+             ENCODING_RAW, ENCODING_DESKTOP_SIZE]
+
+async def read_rect(reader):
+    """Read one rectangle of a FramebufferUpdate; returns its bytes,
+    encoding and geometry"""
+    header = await reader.readexactly(12)
+    x, y, w, h, encoding = struct.unpack('>HHHHi', header)
+    bpp = BYTES_PER_PIXEL
+    parts = [header]
+    if encoding == ENCODING_RAW:
+        parts.append(await reader.readexactly(w * h * bpp))
+    elif encoding == ENCODING_COPYRECT:
+        parts.append(await reader.readexactly(4))
+    elif encoding == ENCODING_RRE:
+        head = await reader.readexactly(4 + bpp)
+        count = struct.unpack_from('>I', head)[0]
+        parts += [head, await reader.readexactly(count * (bpp + 8))]
+    elif encoding == ENCODING_HEXTILE:
+        for ty in range(0, h, 16):
+            for tx in range(0, w, 16):
+                tw, th = min(16, w - tx), min(16, h - ty)
+                sub = await reader.readexactly(1)
+                parts.append(sub)
+                mask = sub[0]
+                if mask & 1:
+                    parts.append(await reader.readexactly(tw * th * bpp))
+                    continue
+                size = (bpp if mask & 2 else 0) + (bpp if mask & 4 else 0)
+                if size:
+                    parts.append(await reader.readexactly(size))
+                if mask & 8:
+                    count = await reader.readexactly(1)
+                    parts.append(count)
+                    size = count[0] * ((bpp if mask & 16 else 0) + 2)
+                    parts.append(await reader.readexactly(size))
+    elif encoding != ENCODING_DESKTOP_SIZE:
+        raise amt_response_error(f'unexpected RFB encoding {encoding}')
+    return b''.join(parts), encoding, w, h
+
+class kvm_viewer:
+    """One RFB client of a kvm_proxy"""
+
+    def __init__(self, proxy, reader, writer):
+        self.proxy = proxy
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.version = None
+        # Output is dropped while behind, until the viewer has drained
+        # and been sent the current screen again
+        self.behind = False
+        # Has seen every update since a full one
+        self.current = False
+        self.wants_update = False
+
+    def send(self, data):
+        if self.behind or self.writer.is_closing():
+            return
+        self.writer.write(data)
+        if self.writer.transport.get_write_buffer_size() > self.proxy.viewer_buffer:
+            self.behind = True
+            self.current = False
+            self.proxy.spawn(self.catch_up())
+
+    async def catch_up(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            return
+        self.behind = False
+        self.proxy.resync(self)
+
+    async def handshake(self):
+        """Authenticate the viewer, who is then to be told the outcome
+        with accept() or refuse()"""
+        self.writer.write(RFB_VERSION)
+        version = self.version = await self.reader.readexactly(12)
+        if version[:4] != b'RFB ':
+            raise amt_response_error('not an RFB client')
+        challenge = os.urandom(16)
+        if version < b'RFB 003.007':
+            self.writer.write(struct.pack('>I', SECURITY_VNC))
+        else:
+            self.writer.write(bytes([1, SECURITY_VNC]))
+            if (await self.reader.readexactly(1))[0] != SECURITY_VNC:
+                raise amt_response_error('viewer refused VNC authentication')
+        self.writer.write(challenge)
+        response = await self.reader.readexactly(16)
+        if response != vnc_response(self.proxy.password, challenge):
+            await self.refuse('Authentication failed')
+            raise amt_connection_error('viewer authentication failed')
+
+    async def accept(self):
+        self.writer.write(struct.pack('>I', 0))
+        # ClientInit; the session is always shared
+        await self.reader.readexactly(1)
+
+    async def refuse(self, reason):
+        self.writer.write(struct.pack('>I', 1))
+        # Only RFB 3.8 viewers are told why
+        if self.version >= b'RFB 003.008':
+            reason = reason.encode('utf-8')
+            self.writer.write(struct.pack('>I', len(reason)) + reason)
+        await self.writer.drain()
+
+    async def run(self):
+        """Pass input on to the host until the viewer disconnects"""
+        proxy = self.proxy
+        while True:
+            msg = await self.reader.readexactly(1)
+            kind = msg[0]
+            if kind == SET_PIXEL_FORMAT:
+                msg += await self.reader.readexactly(19)
+                if msg[4:20] != PIXEL_FORMAT:
+                    proxy.log(f'viewer {self.peer} needs another pixel format, disconnecting')
+                    return
+            elif kind == SET_ENCODINGS:
+                head = await self.reader.readexactly(3)
+                count = struct.unpack_from('>H', head, 1)[0]
+                await self.reader.readexactly(4 * count)
+            elif kind == FRAMEBUFFER_UPDATE_REQUEST:
+                msg += await self.reader.readexactly(9)
+                self.wants_update = True
+                proxy.request_update(self, incremental=msg[1] != 0)
+            elif kind in (KEY_EVENT, POINTER_EVENT):
+                msg += await self.reader.readexactly(7 if kind == KEY_EVENT else 5)
+                proxy.input(msg)
+            elif kind == CLIENT_CUT_TEXT:
+                head = await self.reader.readexactly(7)
+                length = struct.unpack_from('>I', head, 3)[0]
+                proxy.input(msg + head + await self.reader.readexactly(length))
+            else:
+                proxy.log(f'viewer {self.peer} sent unknown message {kind}, disconnecting')
+                return
+
+class kvm_proxy:
+    """Shared KVM session for one AMT host
+
+    Viewers connect with VNC authentication against the AMT password,
+    the same as set as RFBPassword by kvm enable. The session to the
+    host is opened for the first viewer, shared by all of them and
+    closed 'idle' seconds after the last one left, so the number of
+    ME sessions does not grow with the number of viewers.
+
+    Framebuffer updates from the host are passed on to every viewer
+    without decoding. The updates since the last one covering the
+    whole screen are kept, up to 'cache_size' bytes, so that a new or
+    lagging viewer gets the current screen replayed; beyond that the
+    cache is dropped and a full update requested from the host when
+    needed. 'connect' is a coroutine function run before the session
+    to the host is opened, e.g. to start KVM redirection.
+    """
+
+    viewer_buffer = 4 << 20
+
+    def __init__(self, host, password, connect=None, idle=60,
+                 cache_size=16 << 20, view_only=False, log=print):
+        self.host = host
+        self.password = password
+        self.connect = connect
+        self.idle = idle
+        self.cache_size = cache_size
+        self.view_only = view_only
+        self.log = log
+        self.viewers = set()
+        self.tasks = set()
+        self.upstream = None
+        self.opening = None
+        self.idle_timer = None
+        self.reset()
+
+    def reset(self):
+        self.reader = None
+        self.writer = None
+        self.width = self.height = 0
+        self.name = b''
+        self.cache = None
+        self.cache_bytes = 0
+        self.update_pending = False
+        self.full_requested = False
+
+    def spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def server_init(self):
+        return struct.pack('>HH', self.width, self.height) + PIXEL_FORMAT + \
+            struct.pack('>I', len(self.name)) + self.name
+
+    async def open(self):
+        """Connect and authenticate to the host"""
+        if self.connect is not None:
+            await self.connect()
+        try:
+            reader, writer = await asyncio.open_connection(self.host, KVM_PORT)
+        except OSError as e:
+            raise amt_connection_error(f'{self.host}:{KVM_PORT}: {e}')
+        try:
+            version = await reader.readexactly(12)
+            if version[:4] != b'RFB ':
+                raise amt_response_error(f'{self.host}: not an RFB server')
+            writer.write(RFB_VERSION)
+            if version < b'RFB 003.007':
+                types = (await reader.readexactly(4))[3:]
+            else:
+                count = (await reader.readexactly(1))[0]
+                types = await reader.readexactly(count)
+            if SECURITY_VNC in types:
+                security = SECURITY_VNC
+            elif SECURITY_NONE in types:
+                security = SECURITY_NONE
+            else:
+                raise amt_response_error(f'{self.host}: no supported RFB security type in {list(types)}')
+            if version >= b'RFB 003.007':
+                writer.write(bytes([security]))
+            if security == SECURITY_VNC:
+                challenge = await reader.readexactly(16)
+                writer.write(vnc_response(self.password, challenge))
+            if security == SECURITY_VNC or version >= b'RFB 003.008':
+                if struct.unpack('>I', await reader.readexactly(4))[0] != 0:
+                    raise amt_connection_error(f'{self.host}: KVM authentication failed')
+            # ClientInit, shared
+            writer.write(b'\x01')
+            init = await reader.readexactly(24)
+            self.width, self.height = struct.unpack_from('>HH', init)
+            length = struct.unpack_from('>I', init, 20)[0]
+            self.name = await reader.readexactly(length)
+            writer.write(bytes([SET_PIXEL_FORMAT, 0, 0, 0]) + PIXEL_FORMAT)
+            writer.write(struct.pack('>BxH', SET_ENCODINGS, len(ENCODINGS)) +
+                         struct.pack(f'>{len(ENCODINGS)}i', *ENCODINGS))
+        except (OSError, asyncio.IncompleteReadError) as e:
+            writer.close()
+            raise amt_connection_error(f'{self.host}:{KVM_PORT}: {e}')
+        except Exception:
+            writer.close()
+            raise
+        self.reader, self.writer = reader, writer
+        self.log(f'KVM session opened, {self.width}x{self.height}')
+        self.upstream = self.spawn(self.forward())
+        self.request_full()
+
+    async def ensure_open(self):
+        """Open the session to the host unless it is open or opening"""
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        if self.writer is None:
+            if self.opening is None:
+                self.opening = self.spawn(self.open())
+                self.opening.add_done_callback(self.opened)
+            await asyncio.shield(self.opening)
+
+    async def attach(self, viewer):
+        """Add 'viewer', opening the session to the host if needed"""
+        await self.ensure_open()
+        viewer.writer.write(self.server_init())
+        # The viewer's first, full update request gets it the screen
+        self.viewers.add(viewer)
+
+    def opened(self, task):
+        self.opening = None
+
+    def detach(self, viewer):
+        self.viewers.discard(viewer)
+        if not self.viewers and self.writer is not None:
+            self.idle_timer = asyncio.get_running_loop().call_later(
+                self.idle, self.close)
+
+    def close(self):
+        """Close the session to the host; viewers are disconnected"""
+        self.idle_timer = None
+        if self.writer is not None:
+            self.writer.close()
+            self.log('KVM session closed')
+        if self.upstream is not None:
+            self.upstream.cancel()
+            self.upstream = None
+        for viewer in list(self.viewers):
+            viewer.writer.close()
+        self.viewers.clear()
+        self.reset()
+
+    def resync(self, viewer):
+        """Bring 'viewer' up to the current screen"""
+        if self.cache is None:
+            self.request_full()
+            return
+        for msg in self.cache:
+            viewer.send(msg)
+        viewer.current = not viewer.behind
+
+    def request_full(self):
+        if self.writer is None or self.full_requested:
+            return
+        self.full_requested = True
+        self.update_pending = True
+        self.writer.write(struct.pack('>BBHHHH', FRAMEBUFFER_UPDATE_REQUEST, 0,
+                                      0, 0, self.width, self.height))
+
+    def request_update(self, viewer, incremental):
+        """A viewer asks for an update; the host is only ever asked
+        for one at a time"""
+        if not incremental and not viewer.current:
+            self.resync(viewer)
+        if self.writer is None or self.update_pending:
+            return
+        self.update_pending = True
+        self.writer.write(struct.pack('>BBHHHH', FRAMEBUFFER_UPDATE_REQUEST, 1,
+                                      0, 0, self.width, self.height))
+
+    def input(self, msg):
+        if not self.view_only and self.writer is not None:
+            self.writer.write(msg)
+
+    def broadcast(self, msg, full=False):
+        for viewer in list(self.viewers):
+            viewer.wants_update = False
+            viewer.send(msg)
+            if full:
+                viewer.current = not viewer.behind
+
+    def cache_update(self, msg, full):
+        if full:
+            self.cache = [msg]
+            self.cache_bytes = len(msg)
+        elif self.cache is not None:
+            self.cache.append(msg)
+            self.cache_bytes += len(msg)
+        if self.cache_bytes > self.cache_size:
+            self.cache = None
+            self.cache_bytes = 0
+
+    async def forward(self):
+        """Pass messages from the host on to the viewers"""
+        reader = self.reader
+        try:
+            while True:
+                kind = (await reader.readexactly(1))[0]
+                if kind == FRAMEBUFFER_UPDATE:
+                    head = await reader.readexactly(3)
+                    count = struct.unpack_from('>H', head, 1)[0]
+                    parts = [bytes([kind]), head]
+                    area = 0
+                    for _ in range(count):
+                        rect, encoding, w, h = await read_rect(reader)
+                        parts.append(rect)
+                        if encoding == ENCODING_DESKTOP_SIZE:
+                            self.width, self.height = w, h
+                        elif encoding != ENCODING_COPYRECT:
+                            area += w * h
+                    msg = b''.join(parts)
+                    self.update_pending = False
+                    self.full_requested = False
+                    full = area >= self.width * self.height
+                    self.cache_update(msg, full)
+                    self.broadcast(msg, full)
+                    if any(v.wants_update for v in self.viewers):
+                        self.request_update(None, True)
+                elif kind == SET_COLOUR_MAP_ENTRIES:
+                    head = await reader.readexactly(5)
+                    count = struct.unpack_from('>H', head, 3)[0]
+                    await reader.readexactly(6 * count)
+                elif kind == BELL:
+                    self.broadcast(b'\x02')
+                elif kind == SERVER_CUT_TEXT:
+                    head = await reader.readexactly(7)
+                    length = struct.unpack_from('>I', head, 3)[0]
+                    self.broadcast(bytes([kind]) + head +
+                                   await reader.readexactly(length))
+                else:
+                    raise amt_response_error(f'unknown RFB message {kind}')
+        except (OSError, asyncio.IncompleteReadError, amt_response_error) as e:
+            self.log(f'KVM session lost: {e}')
+            self.upstream = None
+            self.close()
+
+    async def serve_viewer(self, reader, writer):
+        viewer = kvm_viewer(self, reader, writer)
+        try:
+            await viewer.handshake()
+            try:
+                await self.ensure_open()
+            except amt_error as e:
+                await viewer.refuse(f'No KVM session to {self.host}: {e}')
+                raise
+            await viewer.accept()
+            await self.attach(viewer)
+            self.log(f'viewer {viewer.peer} connected, {len(self.viewers)} watching')
+            await viewer.run()
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        except amt_error as e:
+            self.log(f'viewer {viewer.peer}: {e}')
+        finally:
+            if viewer in self.viewers:
+                self.detach(viewer)
+                self.log(f'viewer {viewer.peer} left, {len(self.viewers)} watching')
+            writer.close()
+
+    async def serve(self, address, port):
+        """Accept viewers on 'address':'port' until cancelled"""
+        server = await asyncio.start_server(self.serve_viewer, address, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.close()
+            for task in self.tasks:
+                task.cancel()
@@ -0,0 +1,206 @@
+"""Timing and error statistics of WS-Man requests"""
+
+import bisect
+import os
+import threading
+
+class histogram:
+    """Latency histogram over fixed bucket bounds in seconds"""
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile 'q', at most the
+        largest value seen"""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def labels(names, values, extra=''):
+    pairs = [f'{n}="{label_value(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}'
+
+class wsman_metrics:
+    """Timing and error statistics of WS-Man requests
+
+    Sessions record the latency of each operation by endpoint,
+    resource and operation, along with faults, connection errors and
+    cache hits. The async transport adds how long connecting,
+    authenticating, waiting for the firmware and reading and parsing
+    the response took, and its retries. A single instance can be
+    shared by the sessions of many hosts and threads.
+    """
+
+    # name, type, help, labels
+    families = [
+        ('wsman_request_seconds', 'histogram', 'WS-Man operation latency',
+         ('host', 'resource', 'op')),
+        ('wsman_phase_seconds', 'histogram',
+         'Time spent connecting, authenticating, waiting for the firmware and parsing',
+         ('host', 'phase')),
+        ('wsman_faults', 'counter', 'SOAP faults', ('host', 'resource', 'reason')),
+        ('wsman_errors', 'counter', 'Requests without a response', ('host', 'resource')),
+        ('wsman_retries', 'counter', 'Requests sent again', ('host', 'reason')),
+        ('wsman_cache_hits', 'counter', 'Get requests served from the cache',
+         ('host', 'resource')),
+        ('wsman_firmware', 'info', 'Firmware reported by Identify',
+         ('host', 'vendor', 'version')),
+    ]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = {name: {} for name, *_ in self.families}
+
+    def observe(self, name, key, value):
+        with self.lock:
+            h = self.tables[name].get(key)
+            if h is None:
+                h = self.tables[name][key] = histogram()
+            h.observe(value)
+
+    def increment(self, name, key):
+        with self.lock:
+            table = self.tables[name]
+            table[key] = table.get(key, 0) + 1
+
+    def request(self, host, resource, op, seconds):
+        self.observe('wsman_request_seconds', (host, resource, op), seconds)
+
+    def phase(self, host, phase, seconds):
+        self.observe('wsman_phase_seconds', (host, phase), seconds)
+
+    def fault(self, host, resource, reason):
+        self.increment('wsman_faults', (host, resource, reason))
+
+    def error(self, host, resource):
+        self.increment('wsman_errors', (host, resource))
+
+    def retry(self, host, reason):
+        self.increment('wsman_retries', (host, reason))
+
+    def cache_hit(self, host, resource):
+        self.increment('wsman_cache_hits', (host, resource))
+
+    def firmware(self, host, vendor, version):
+        with self.lock:
+            table = self.tables['wsman_firmware']
+            for key in [k for k in table if k[0] == host]:
+                del table[key]
+            table[(host, vendor, version)] = 1
+
+    def openmetrics(self):
+        """Return all statistics in the OpenMetrics text format"""
+        lines = []
+        with self.lock:
+            for name, kind, help, names in self.families:
+                lines.append(f'# TYPE {name} {kind}')
+                lines.append(f'# HELP {name} {help}')
+                for key, value in sorted(self.tables[name].items()):
+                    if kind in ('counter', 'info'):
+                        suffix = '_total' if kind == 'counter' else '_info'
+                        lines.append(f'{name}{suffix}{labels(names, key)} {value}')
+                        continue
+                    total = 0
+                    for bound, n in zip(histogram.buckets + ('+Inf',), value.counts):
+                        total += n
+                        le = f'le="{bound}"'
+                        lines.append(f'{name}_bucket{labels(names, key, le)} {total}')
+                    lines.append(f'{name}_sum{labels(names, key)} {value.sum}')
+                    lines.append(f'{name}_count{labels(names, key)} {value.count}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Return the statistics as human-readable lines"""
+        ms = lambda v: f'{v * 1000:.1f} ms'
+        lines = []
+        with self.lock:
+            requests = sorted(self.tables['wsman_request_seconds'].items())
+            phases = {}
+            for (host, phase), h in sorted(self.tables['wsman_phase_seconds'].items()):
+                phases.setdefault(host, []).append(f'{phase} {ms(h.sum / h.count)}')
+            counters = [(title, sorted(self.tables[name].items()))
+                        for title, name in [('Faults', 'wsman_faults'),
+                                            ('No response', 'wsman_errors'),
+                                            ('Retries', 'wsman_retries'),
+                                            ('Cache hits', 'wsman_cache_hits')]]
+            firmware = sorted(self.tables['wsman_firmware'])
+        if requests:
+            lines.append('Requests:')
+        for (host, resource, op), h in requests:
+            lines.append(f'  {host} {resource} {op}: {h.count} requests, '
+                         f'mean {ms(h.sum / h.count)}, p50 <= {ms(h.quantile(0.5))}, '
+                         f'p99 <= {ms(h.quantile(0.99))}, max {ms(h.max)}')
+        if phases:
+            lines.append('Mean time per phase:')
+        for host, values in phases.items():
+            lines.append(f'  {host}: {", ".join(values)}')
+        if firmware:
+            lines.append('Firmware:')
+        for key in firmware:
+            lines.append(f'  {" ".join(key)}')
+        for title, items in counters:
+            if items:
+                lines.append(f'{title}:')
+            for key, n in items:
+                lines.append(f'  {" ".join(key)}: {n}')
+        return '\n'.join(lines)
+
+    def save(self, path):
+        """Write the statistics in OpenMetrics format to 'path', for
+        collectors reading text files"""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.openmetrics())
+        os.replace(tmp, path)
+
+    def serve(self, address, port):
+        """Serve the statistics on http://address:port/metrics from a
+        background thread; returns the server"""
+        # Imported here, http.server is slow to load
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.openmetrics().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((address, port), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='wsman-metrics',
+                         daemon=True).start()
+        return server
@@ -0,0 +1,318 @@
+"""Stand-in AMT WS-Man endpoint for testing and benchmarks
+
+Emulates Get, Put and the state change methods of the services
+wsman_amt talks to, the Enumerate/Pull of AMT_EventLogEntry and the
+HTTP digest authentication of the firmware, with configurable
+latency and injected faults and dropped connections. Several hosts
+are served on consecutive ports, each with its own state:
+
+    python3 -m wsman_amt.mock --hosts 16 --latency 5 --fault-rate 0.01
+"""
+
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import re
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+from .soap import XML_NS_SOAP_1_2, XML_NS_ADDRESSING, XML_NS_TRANSFER, \
+    XML_NS_ENUMERATION, XML_NS_WS_MAN, XML_NS_WSMAN_ID, XML_NS_CIM_CLASS, \
+    XML_NS_AMT_CLASS, XML_NS_IPS_CLASS, xml_tag
+
+REDIRECTION = XML_NS_AMT_CLASS + '/AMT_RedirectionService'
+KVM_SETTINGS = XML_NS_IPS_CLASS + '/IPS_KVMRedirectionSettingData'
+KVM_SAP = XML_NS_CIM_CLASS + '/CIM_KVMRedirectionSAP'
+POWER = XML_NS_CIM_CLASS + '/CIM_AssociatedPowerManagementService'
+POWER_SERVICE = XML_NS_CIM_CLASS + '/CIM_PowerManagementService'
+EVENT_LOG = XML_NS_AMT_CLASS + '/AMT_EventLogEntry'
+
+# Power state reached by each RequestPowerStateChange value
+power_result_map = { 5: 2, 9: 2, 10: 2, 11: 2, 14: 2, 15: 2, 16: 2,
+                     8: 6, 12: 6, 13: 6 }
+# Power cycles, which are off for a while before they reach it
+power_cycle_values = (5, 9, 15, 16)
+
+def envelope(body):
+    return (f'<s:Envelope xmlns:s="{XML_NS_SOAP_1_2}"><s:Header/>'
+            f'<s:Body>{body}</s:Body></s:Envelope>').encode('utf-8')
+
+def instance(uri, properties, name=None):
+    name = name or uri.rpartition('/')[2]
+    props = ''.join(f'<g:{k}>{escape(v)}</g:{k}>' for k, v in properties.items())
+    return f'<g:{name} xmlns:g="{uri}">{props}</g:{name}>'
+
+def fault(subcode, reason):
+    return envelope(f'<s:Fault><s:Code><s:Value>s:Sender</s:Value>'
+                    f'<s:Subcode><s:Value xmlns:w="{XML_NS_WS_MAN}">w:{subcode}</s:Value>'
+                    f'</s:Subcode></s:Code><s:Reason><s:Text xml:lang="en">'
+                    f'{escape(reason)}</s:Text></s:Reason></s:Fault>')
+
+class mock_host:
+    """State of one emulated AMT system"""
+
+    def __init__(self, events):
+        self.instances = {
+            REDIRECTION: { 'ElementName': 'Intel(r) AMT Redirection Service',
+                           'EnabledState': '32771', 'ListenerEnabled': 'true' },
+            KVM_SETTINGS: { 'Is5900PortEnabled': 'false', 'OptInPolicy': 'true',
+                            'SessionTimeout': '5', 'RFBPassword': '' },
+            KVM_SAP: { 'EnabledState': '3' },
+            POWER: { 'PowerState': '2', 'RequestedPowerState': '2',
+                     'AvailableRequestedPowerStates': '2' } }
+        self.events = events
+        self.contexts = {}
+
+class mock_amt:
+    """WS-Man server for 'hosts' emulated systems
+
+    'latency' and 'jitter' are in seconds; each request is delayed by
+    latency plus up to jitter. A 'fault_rate' fraction of requests
+    gets a SOAP fault, a 'drop_rate' fraction has its connection
+    closed without a response, and a 'busy_rate' fraction of state
+    changes is refused with ReturnValue 4099 (Busy). Power changes
+    take effect after 'power_delay' seconds; power cycles are off
+    until then, and for at least one second.
+    """
+
+    realm = 'Digest:A0B1C2D3E4F5061728394A5B6C7D8E9F'
+
+    def __init__(self, hosts=1, username='admin', password='secret',
+                 latency=0, jitter=0, fault_rate=0, drop_rate=0,
+                 power_delay=0, events=100, seed=None, busy_rate=0):
+        self.hosts = [mock_host(events) for _ in range(hosts)]
+        self.ha1 = hashlib.md5(f'{username}:{self.realm}:{password}'.encode()).hexdigest()
+        self.nonce = os.urandom(16).hex()
+        self.latency = latency
+        self.jitter = jitter
+        self.fault_rate = fault_rate
+        self.drop_rate = drop_rate
+        self.busy_rate = busy_rate
+        self.power_delay = power_delay
+        self.random = random.Random(seed)
+        self.servers = []
+        self.stats = { 'connections': 0, 'requests': 0, 'challenges': 0,
+                       'faults': 0, 'dropped': 0, 'busy': 0 }
+
+    async def start(self, address='127.0.0.1', port=16992):
+        """Listen on 'port' and the following ports, one per host"""
+        for i, host in enumerate(self.hosts):
+            server = await asyncio.start_server(
+                lambda r, w, host=host: self.serve(host, r, w), address, port + i)
+            self.servers.append(server)
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+
+    def authorized(self, header):
+        if not header.startswith('Digest '):
+            return False
+        p = {k.lower(): v1 or v2 for k, v1, v2 in
+             re.findall(r'(\w+)=(?:"([^"]*)"|([^,\s]*))', header[7:])}
+        if p.get('nonce') != self.nonce or 'uri' not in p:
+            return False
+        md5 = lambda s: hashlib.md5(s.encode()).hexdigest()
+        ha2 = md5(f'POST:{p["uri"]}')
+        if 'qop' in p:
+            expected = md5(f'{self.ha1}:{self.nonce}:{p.get("nc")}:{p.get("cnonce")}:{p["qop"]}:{ha2}')
+        else:
+            expected = md5(f'{self.ha1}:{self.nonce}:{ha2}')
+        return p.get('response') == expected
+
+    async def serve(self, host, reader, writer):
+        self.stats['connections'] += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    k, _, v = line.decode('latin-1').partition(':')
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.stats['requests'] += 1
+                delay = self.latency + self.random.uniform(0, self.jitter)
+                if delay:
+                    await asyncio.sleep(delay)
+                if not self.authorized(headers.get('authorization', '')):
+                    self.stats['challenges'] += 1
+                    writer.write(b'HTTP/1.1 401 Unauthorized\r\n'
+                                 b'WWW-Authenticate: Digest realm="' + self.realm.encode() +
+                                 b'", nonce="' + self.nonce.encode() +
+                                 b'", qop="auth"\r\nContent-Length: 0\r\n\r\n')
+                    await writer.drain()
+                    continue
+                if self.drop_rate and self.random.random() < self.drop_rate:
+                    self.stats['dropped'] += 1
+                    break
+                if self.fault_rate and self.random.random() < self.fault_rate:
+                    self.stats['faults'] += 1
+                    code, data = 500, fault('TimedOut', 'Injected fault')
+                else:
+                    code, data = self.handle(host, body)
+                writer.write(f'HTTP/1.1 {code} {"OK" if code == 200 else "Error"}\r\n'
+                             f'Content-Type: application/soap+xml;charset=UTF-8\r\n'
+                             f'Content-Length: {len(data)}\r\n\r\n'.encode('latin-1') + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def handle(self, host, body):
+        """Return the HTTP status and response to the request 'body'"""
+        try:
+            env = ET.fromstring(body)
+        except ET.ParseError as e:
+            return 400, fault('InvalidMessageInformationHeader', str(e))
+        header = env.find(xml_tag(XML_NS_SOAP_1_2, 'Header'))
+        request = env.find(xml_tag(XML_NS_SOAP_1_2, 'Body'))
+        request = request[0] if request is not None and len(request) else None
+        action = header.findtext(xml_tag(XML_NS_ADDRESSING, 'Action')) if header is not None else None
+        uri = header.findtext(xml_tag(XML_NS_WS_MAN, 'ResourceURI')) if header is not None else None
+        if action is None:
+            return 200, envelope(instance(XML_NS_WSMAN_ID, {
+                'ProtocolVersion': XML_NS_WS_MAN, 'ProductVendor': 'Intel Corporation',
+                'ProductVersion': 'AMT 11.8'}, 'IdentifyResponse'))
+        if action == XML_NS_TRANSFER + '/Get' and uri in host.instances:
+            return 200, envelope(instance(uri, host.instances[uri]))
+        if action == XML_NS_TRANSFER + '/Put' and uri in host.instances:
+            props = host.instances[uri]
+            for e in request if request is not None else ():
+                name = e.tag.rpartition('}')[2]
+                if name in props:
+                    props[name] = e.text or ''
+            return 200, envelope(instance(uri, props))
+        if action.startswith(XML_NS_ENUMERATION) and uri == EVENT_LOG:
+            return self.enumerate(host, action.rpartition('/')[2], request)
+        if action.endswith('StateChange') and self.busy_rate and \
+           self.random.random() < self.busy_rate:
+            self.stats['busy'] += 1
+            return 200, self.output(uri, action.rpartition('/')[2], 4099)
+        if action == uri + '/RequestStateChange' and uri in (REDIRECTION, KVM_SAP):
+            state = request.findtext(xml_tag(uri, 'RequestedState'))
+            valid = (32768, 32769, 32770, 32771) if uri == REDIRECTION else (2, 3)
+            value = 5
+            if state is not None and state.isdigit() and int(state) in valid:
+                host.instances[uri]['EnabledState'] = state
+                value = 0
+            return 200, self.output(uri, 'RequestStateChange', value)
+        if action == KVM_SETTINGS + '/TerminateSession':
+            return 200, self.output(KVM_SETTINGS, 'TerminateSession', 0)
+        if action == POWER_SERVICE + '/RequestPowerStateChange':
+            state = request.findtext(xml_tag(POWER_SERVICE, 'PowerState'))
+            if state is None or not state.isdigit() or not 2 <= int(state) <= 16:
+                return 200, self.output(POWER_SERVICE, 'RequestPowerStateChange', 5)
+            self.power_change(host, int(state))
+            return 200, self.output(POWER_SERVICE, 'RequestPowerStateChange', 0)
+        return 400, fault('DestinationUnreachable', f'No route for {action} on {uri}')
+
+    def output(self, uri, method, value):
+        return envelope(instance(uri, {'ReturnValue': str(value)}, method + '_OUTPUT'))
+
+    def power_change(self, host, state):
+        power = host.instances[POWER]
+        power['RequestedPowerState'] = str(state)
+        new = str(power_result_map.get(state, state))
+        if state in power_cycle_values:
+            power['PowerState'] = '6'
+            asyncio.get_running_loop().call_later(
+                max(self.power_delay, 1), power.__setitem__, 'PowerState', new)
+        elif self.power_delay:
+            asyncio.get_running_loop().call_later(
+                self.power_delay, power.__setitem__, 'PowerState', new)
+        else:
+            power['PowerState'] = new
+
+    def enumerate(self, host, action, request):
+        tag = lambda name: xml_tag(XML_NS_ENUMERATION, name)
+        if action == 'Release':
+            host.contexts.pop(request.findtext(tag('EnumerationContext')), None)
+            return 200, envelope(f'<n:ReleaseResponse xmlns:n="{XML_NS_ENUMERATION}"/>')
+        if action == 'Enumerate':
+            context = os.urandom(8).hex()
+            host.contexts[context] = 0
+            optimize = request.find(xml_tag(XML_NS_WS_MAN, 'OptimizeEnumeration')) is not None
+            count = request.findtext(xml_tag(XML_NS_WS_MAN, 'MaxElements'))
+            items_ns = 'w'
+        else:
+            context = request.findtext(tag('EnumerationContext'))
+            if context not in host.contexts:
+                return 400, fault('InvalidEnumerationContext', 'Unknown enumeration context')
+            optimize = True
+            count = request.findtext(tag('MaxElements'))
+            items_ns = 'n'
+        pos = host.contexts[context]
+        end = pos
+        if optimize:
+            end = min(host.events, pos + max(1, int(count or 1)))
+        items = ''.join(instance(EVENT_LOG, { 'LogCreationClassName': 'AMT_MessageLog',
+                                              'RecordID': str(i),
+                                              'EventData': '0' * 64 })
+                        for i in range(pos, end))
+        response = 'EnumerateResponse' if action == 'Enumerate' else 'PullResponse'
+        body = (f'<n:{response} xmlns:n="{XML_NS_ENUMERATION}" xmlns:w="{XML_NS_WS_MAN}">'
+                f'<n:EnumerationContext>{context}</n:EnumerationContext>'
+                f'<{items_ns}:Items>{items}</{items_ns}:Items>')
+        if end >= host.events:
+            del host.contexts[context]
+            body += f'<{items_ns}:EndOfSequence/>'
+        else:
+            host.contexts[context] = end
+        return 200, envelope(body + f'</n:{response}>')
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in AMT WS-Man endpoint')
+    parser.add_argument('--listen', metavar='ADDRESS', default='127.0.0.1',
+                        help='Address to listen on, default 127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=16992,
+                        help='Port of the first host, default 16992')
+    parser.add_argument('-n', '--hosts', metavar='N', type=int, default=1,
+                        help='Number of hosts, on consecutive ports, default 1')
+    parser.add_argument('-U', '--username', default='admin')
+    parser.add_argument('-P', '--password', default='secret')
+    parser.add_argument('--latency', metavar='MS', type=float, default=0,
+                        help='Delay of each request in milliseconds')
+    parser.add_argument('--jitter', metavar='MS', type=float, default=0,
+                        help='Additional random delay up to MS milliseconds')
+    parser.add_argument('--fault-rate', metavar='P', type=float, default=0,
+                        help='Fraction of requests answered with a SOAP fault')
+    parser.add_argument('--drop-rate', metavar='P', type=float, default=0,
+                        help='Fraction of requests whose connection is closed')
+    parser.add_argument('--busy-rate', metavar='P', type=float, default=0,
+                        help='Fraction of state changes refused as busy')
+    parser.add_argument('--power-delay', metavar='SECONDS', type=float, default=0,
+                        help='Time power changes take to complete')
+    parser.add_argument('--events', metavar='N', type=int, default=100,
+                        help='Number of AMT_EventLogEntry instances, default 100')
+    parser.add_argument('--seed', type=int, help='Seed for latency and faults')
+    args = parser.parse_args()
+
+    async def run():
+        mock = mock_amt(args.hosts, args.username, args.password,
+                        args.latency / 1000, args.jitter / 1000,
+                        args.fault_rate, args.drop_rate, args.power_delay,
+                        args.events, args.seed, args.busy_rate)
+        await mock.start(args.listen, args.port)
+        print(f'Serving {args.hosts} hosts on {args.listen}:{args.port}'
+              f'-{args.port + args.hosts - 1}', flush=True)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            mock.close()
+            print(', '.join(f'{k} {v}' for k, v in mock.stats.items()), flush=True)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
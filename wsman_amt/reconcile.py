@@ -0,0 +1,52 @@
+"""Desired-state files for wsman_amt.reconcile()"""
+
+import json
+
+from .amt import wsman_amt
+
+desired_state_keys = { 'power': str, 'sol': bool, 'ider': bool,
+                       'listener': bool, 'kvm_port_5900': bool,
+                       'kvm_opt_in': bool, 'kvm_session_timeout': int,
+                       'kvm_password': str }
+
+def load_desired_state(path):
+    """Read a JSON or YAML file mapping host group names to a list of
+    'hosts' and their desired settings; returns the settings per host.
+    Hosts in several groups get the settings of all of them, later
+    groups taking precedence."""
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError(f'PyYAML is required to read {path}')
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError('expected a mapping of host groups')
+    hosts = {}
+    for group, settings in config.items():
+        if not isinstance(settings, dict):
+            raise ValueError(f'{group}: expected a mapping of settings')
+        settings = dict(settings)
+        members = settings.pop('hosts', [])
+        if not isinstance(members, list) or \
+           not all(isinstance(h, str) for h in members):
+            raise ValueError(f'{group}: hosts must be a list of host names')
+        # YAML reads a bare on/off as a boolean
+        if isinstance(settings.get('power'), bool):
+            settings['power'] = 'on' if settings['power'] else 'off'
+        for key, value in settings.items():
+            if key not in desired_state_keys:
+                raise ValueError(f'{group}: unknown setting {key}')
+            # bool is an int as well
+            if not isinstance(value, desired_state_keys[key]) or \
+               isinstance(value, bool) and desired_state_keys[key] is not bool:
+                raise ValueError(f'{group}: invalid value {value!r} for {key}')
+        if 'power' in settings and \
+           settings['power'] not in wsman_amt.power_converged_map:
+            raise ValueError(f'{group}: invalid power state {settings["power"]}')
+        for host in members:
+            hosts.setdefault(host, {}).update(settings)
+    return hosts
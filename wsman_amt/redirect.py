@@ -0,0 +1,252 @@
+"""AMT redirection protocol sessions on port 16994/16995"""
+
+import asyncio
+import hashlib
+import os
+import ssl
+import struct
+
+from .errors import amt_error, amt_connection_error, amt_response_error
+
+REDIRECTION_PORT = 16994
+REDIRECTION_TLS_PORT = 16995
+
+START_REDIRECTION_SESSION = 0x10
+START_REDIRECTION_SESSION_REPLY = 0x11
+END_REDIRECTION_SESSION = 0x12
+AUTHENTICATE_SESSION = 0x13
+AUTHENTICATE_SESSION_REPLY = 0x14
+
+AUTH_QUERY = 0
+AUTH_DIGEST = 3
+AUTH_DIGEST_QOP = 4
+
+class redirection_protocol(asyncio.BufferedProtocol):
+    """Client side of an AMT redirection session
+
+    Starts a session of 'session_type' and authenticates it with HTTP
+    digest, then calls authenticated(). Incoming messages are parsed
+    in place in a fixed receive buffer of 'buffer_size' bytes and
+    passed to handle(); subclasses list their fixed message sizes in
+    'message_size_map' and may stream the payload of data messages,
+    see data_header(). 'started' resolves once the subclass calls
+    running(), 'closed' when the session ends, with an amt_error if
+    it failed.
+    """
+
+    session_type = b''
+    buffer_size = 4096
+    message_size_map = {}
+    redirection_uri = '/RedirectionService'
+
+    def __init__(self, username, password):
+        self.username = username.encode()
+        self.password = password.encode()
+        self.buf = bytearray(self.buffer_size)
+        self.used = 0
+        # Payload bytes of the current data message still to come
+        self.remaining = 0
+        self.seq = 0
+        self.auth_type = None
+        self.auth_sent = False
+        self.is_running = False
+        self.transport = None
+        self.tasks = set()
+        loop = asyncio.get_running_loop()
+        self.started = loop.create_future()
+        self.closed = loop.create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.transport.write(bytes([START_REDIRECTION_SESSION, 0, 0, 0]) +
+                             self.session_type)
+
+    def connection_lost(self, exc):
+        for task in self.tasks:
+            task.cancel()
+        if exc is None and not self.is_running:
+            exc = amt_connection_error('redirection session closed during setup')
+        elif exc is not None and not isinstance(exc, amt_error):
+            exc = amt_connection_error(str(exc))
+        self.finish(exc)
+
+    def finish(self, exc=None):
+        for f in (self.started, self.closed):
+            if f.done():
+                continue
+            if exc is None:
+                f.set_result(None)
+            else:
+                f.set_exception(exc)
+                # Not every caller waits for both
+                f.exception()
+
+    def fail(self, msg, error=amt_response_error):
+        self.finish(error(msg))
+        self.transport.close()
+
+    def running(self):
+        self.is_running = True
+        if not self.started.done():
+            self.started.set_result(None)
+
+    def spawn(self, coro):
+        """Run 'coro' until it completes or the session ends"""
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def send(self, cmd, payload=b'', attributes=0):
+        self.seq += 1
+        self.transport.write(struct.pack('<BxxBI', cmd, attributes, self.seq) +
+                             payload)
+
+    def close(self):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(bytes([END_REDIRECTION_SESSION, 0, 0, 0]))
+            self.transport.close()
+
+    def get_buffer(self, sizehint):
+        return memoryview(self.buf)[self.used:]
+
+    def buffer_updated(self, nbytes):
+        self.used += nbytes
+        view = memoryview(self.buf)
+        pos = 0
+        while pos < self.used and not self.closed.done():
+            if self.remaining:
+                n = min(self.remaining, self.used - pos)
+                self.data(view[pos:pos + n])
+                self.remaining -= n
+                pos += n
+                continue
+            size = self.message_size(view[pos:self.used])
+            if size is None:
+                break
+            header = self.data_header(view[pos])
+            if header is not None:
+                self.remaining = size - header
+                pos += header
+                continue
+            if self.used - pos < size:
+                break
+            self.handle(bytes(view[pos:pos + size]))
+            pos += size
+        view.release()
+        # Keep a partial message at the start of the buffer
+        self.buf[:self.used - pos] = self.buf[pos:self.used]
+        self.used -= pos
+        if self.used == len(self.buf):
+            self.fail('redirection message exceeds receive buffer')
+
+    def message_size(self, data):
+        """Return the size of the message at the start of 'data', or
+        None if its header is incomplete"""
+        cmd = data[0]
+        if cmd in self.message_size_map:
+            return self.message_size_map[cmd]
+        if cmd == START_REDIRECTION_SESSION_REPLY:
+            return 13 + data[12] if len(data) >= 13 else None
+        if cmd == AUTHENTICATE_SESSION_REPLY:
+            return 9 + struct.unpack_from('<I', data, 5)[0] if len(data) >= 9 else None
+        self.fail(f'unknown redirection message {cmd:#x}')
+        return None
+
+    def data_header(self, cmd):
+        """Return the header size of 'cmd' if it is a data message whose
+        payload is passed to data() as it arrives, otherwise None"""
+        return None
+
+    def data(self, view):
+        """Payload of a data message; 'view' is only valid during the call"""
+
+    def handle(self, msg):
+        cmd = msg[0]
+        if cmd == START_REDIRECTION_SESSION_REPLY:
+            if msg[1] != 0:
+                return self.fail(f'redirection session refused, status {msg[1]}')
+            self.transport.write(struct.pack('<BxxxBI', AUTHENTICATE_SESSION,
+                                             AUTH_QUERY, 0))
+        elif cmd == AUTHENTICATE_SESSION_REPLY:
+            self.authenticate(msg[1], msg[4], msg[9:])
+
+    def authenticate(self, status, auth_type, data):
+        if auth_type == AUTH_QUERY:
+            if AUTH_DIGEST_QOP in data:
+                self.auth_type = AUTH_DIGEST_QOP
+            elif AUTH_DIGEST in data:
+                self.auth_type = AUTH_DIGEST
+            else:
+                return self.fail(f'no supported authentication in {list(data)}')
+            # Ask for a digest challenge
+            self.send_auth([self.username, b'', b'',
+                            self.redirection_uri.encode(), b'', b'', b''] +
+                           ([b''] if self.auth_type == AUTH_DIGEST_QOP else []))
+        elif status == 0:
+            self.authenticated()
+        elif self.auth_sent:
+            self.fail('redirection authentication failed', amt_connection_error)
+        else:
+            self.digest(data)
+
+    def send_auth(self, fields):
+        payload = b''.join(bytes([len(f)]) + f for f in fields)
+        self.transport.write(struct.pack('<BxxxBI', AUTHENTICATE_SESSION,
+                                         self.auth_type, len(payload)) + payload)
+
+    def digest(self, data):
+        fields = []
+        pos = 0
+        while pos < len(data):
+            fields.append(data[pos + 1:pos + 1 + data[pos]])
+            pos += 1 + data[pos]
+        if len(fields) < 2:
+            return self.fail('invalid digest challenge')
+        realm, nonce = fields[0], fields[1]
+        qop = fields[2] if len(fields) > 2 else b'auth'
+        uri = self.redirection_uri.encode()
+        cnonce = os.urandom(16).hex().encode()
+        nc = b'00000002'
+        md5 = lambda s: hashlib.md5(s).hexdigest().encode()
+        ha1 = md5(self.username + b':' + realm + b':' + self.password)
+        ha2 = md5(b'POST:' + uri)
+        if self.auth_type == AUTH_DIGEST_QOP:
+            response = md5(b':'.join([ha1, nonce, nc, cnonce, qop, ha2]))
+            fields = [self.username, realm, nonce, uri, cnonce, nc, response, qop]
+        else:
+            response = md5(b':'.join([ha1, nonce, ha2]))
+            fields = [self.username, realm, nonce, uri, cnonce, nc, response]
+        self.auth_sent = True
+        self.send_auth(fields)
+
+    def authenticated(self):
+        """Start the redirection after successful authentication"""
+        raise NotImplementedError
+
+async def redirection_connect(factory, host, tls=False, timeout=None):
+    """Connect a redirection_protocol created by 'factory' to 'host'
+    and return it once it is running"""
+    loop = asyncio.get_running_loop()
+    port = REDIRECTION_TLS_PORT if tls else REDIRECTION_PORT
+    context = ssl.create_default_context() if tls else None
+    protocol = None
+    try:
+        _, protocol = await asyncio.wait_for(
+            loop.create_connection(factory, host, port, ssl=context), timeout)
+        await asyncio.wait_for(asyncio.shield(protocol.started), timeout)
+    except (OSError, asyncio.TimeoutError) as e:
+        if protocol is not None:
+            protocol.close()
+        raise amt_connection_error(f'{host}:{port}: {e or "timeout"}')
+    return protocol
+
+async def redirection_wait(protocol, duration=None):
+    """Keep the session of 'protocol' open until it ends or 'duration'
+    seconds have passed"""
+    try:
+        await asyncio.wait_for(asyncio.shield(protocol.closed), duration)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        protocol.close()
@@ -0,0 +1,127 @@
+"""Values returned by wsman_amt methods"""
+
+class amt_result:
+    """Base class of the values returned by wsman_amt methods
+
+    str() gives the human-readable line printed by the CLI,
+    as_dict() the fields for machine-readable output.
+    """
+
+    ok = True
+
+    def as_dict(self):
+        d = {}
+        for k, v in vars(self).items():
+            d[k] = v.as_dict() if isinstance(v, amt_result) else v
+        return d
+
+class identify_result(amt_result):
+    def __init__(self, vendor, version):
+        self.vendor = vendor
+        self.version = version
+
+    def __str__(self):
+        return f'{self.vendor} {self.version}'
+
+class power_result(amt_result):
+    def __init__(self, state, state_name, requested, requested_name,
+                 available, available_name):
+        self.state = state
+        self.state_name = state_name
+        self.requested = requested
+        self.requested_name = requested_name
+        self.available = available
+        self.available_name = available_name
+
+    def __str__(self):
+        return f'Power: {self.state_name}, Last Requested: {self.requested_name}, Available: {self.available_name}'
+
+class redirection_result(amt_result):
+    def __init__(self, name, state, state_name, sol, ider, listener):
+        self.name = name
+        self.state = state
+        self.state_name = state_name
+        self.sol = sol
+        self.ider = ider
+        self.listener = listener
+
+    def __str__(self):
+        listener = 'enabled' if self.listener else 'disabled'
+        return f'{self.name}: {self.state_name}, Listener is {listener}'
+
+class kvm_result(amt_result):
+    def __init__(self, port_5900, opt_in, session_timeout):
+        self.port_5900 = port_5900
+        self.opt_in = opt_in
+        self.session_timeout = session_timeout
+
+    def __str__(self):
+        e = 'true' if self.port_5900 else 'false'
+        p = 'true' if self.opt_in else 'false'
+        return f'Port 5900 Enabled: {e}, Opt-In Policy: {p}, session timeout {self.session_timeout}'
+
+class status_result(amt_result):
+    def __init__(self, identify, power, redirection, kvm):
+        self.identify = identify
+        self.power = power
+        self.redirection = redirection
+        self.kvm = kvm
+
+    def __str__(self):
+        return '\n'.join(str(r) for r in (self.identify, self.power,
+                                           self.redirection, self.kvm)
+                         if r is not None)
+
+class instance_result(amt_result):
+    """One instance from wsman_amt.enumerate()"""
+
+    def __init__(self, name, properties):
+        self.name = name
+        self.properties = properties
+
+    def __str__(self):
+        return ', '.join(f'{k}: {v}' for k, v in self.properties.items())
+
+class enumeration_result(amt_result):
+    """Summary of an enumeration, whose instances were output as they
+    came in"""
+
+    def __init__(self, name, count):
+        self.name = name
+        self.count = count
+
+    def __str__(self):
+        return f'{self.count} instances of {self.name}'
+
+class change_result(amt_result):
+    """Outcome of a setter; 'changed' is False if the system already
+    was in the requested state"""
+
+    def __init__(self, changed, message, ok=True, return_value=None):
+        self.changed = changed
+        self.message = message
+        self.ok = ok
+        self.return_value = return_value
+
+    def __str__(self):
+        return self.message
+
+class reconcile_result(amt_result):
+    """Outcome of wsman_amt.reconcile(); 'failed' maps the settings
+    which could not be applied to the reason"""
+
+    def __init__(self, changed, failed):
+        self.changed = changed
+        self.failed = failed
+        self.ok = not failed
+
+    def __str__(self):
+        lines = []
+        if self.failed:
+            lines.append('Failed to apply ' +
+                         ', '.join(f'{k} ({v})' for k, v in self.failed.items()))
+        if self.changed:
+            lines.append(f'Changed {", ".join(self.changed)}')
+        elif not self.failed:
+            lines.append('Converged')
+        return '\n'.join(lines)
@@ -0,0 +1,124 @@
+"""Retrying failed requests and skipping endpoints which keep failing"""
+
+import random
+import threading
+import time
+
+from .errors import amt_error, amt_connect_error, amt_connection_error, \
+    amt_unavailable_error, amt_busy_error
+
+class circuit_breaker:
+    """Skip endpoints which repeatedly failed to respond
+
+    After 'failures' consecutive requests to an endpoint without a
+    response, further requests raise amt_unavailable_error right away
+    for 'cooldown' seconds. The next request after that is sent as a
+    probe; while it runs the endpoint stays skipped, and if it fails
+    too the endpoint is skipped for another 'cooldown'. Any response,
+    faults included, resets the count. A single instance can be shared
+    by the sessions of many hosts and threads.
+    """
+
+    def __init__(self, failures=3, cooldown=60):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        # endpoint: [consecutive failures, time skipping started]
+        self.endpoints = {}
+        self.skipped = 0
+
+    def admit(self, endpoint):
+        """Raise amt_unavailable_error if 'endpoint' is skipped"""
+        now = time.monotonic()
+        with self.lock:
+            state = self.endpoints.get(endpoint)
+            if state is None or state[0] < self.failures:
+                return
+            wait = state[1] + self.cooldown - now
+            if wait <= 0:
+                # Let this one probe the endpoint
+                state[1] = now
+                return
+            self.skipped += 1
+        raise amt_unavailable_error(f'{endpoint}: skipped after {state[0]} failed requests, '
+                                    f'next attempt in {wait:.0f}s')
+
+    def success(self, endpoint):
+        with self.lock:
+            self.endpoints.pop(endpoint, None)
+
+    def failure(self, endpoint):
+        with self.lock:
+            state = self.endpoints.setdefault(endpoint, [0, 0])
+            state[0] += 1
+            if state[0] >= self.failures:
+                state[1] = time.monotonic()
+
+class retry_policy:
+    """When and how often to send a failed request again
+
+    A request is sent up to 'attempts' times, waiting 'backoff'
+    seconds before the second attempt and twice as long before each
+    further one, up to 'max_backoff', with random jitter. Requests
+    which cannot have taken effect are retried: those which found the
+    firmware busy and those for which no connection could be made.
+    Idempotent requests are also retried after losing the connection
+    and on TimedOut faults, but not after a timeout, which already
+    took as long as the caller is willing to wait. With a
+    circuit_breaker, skipped endpoints are not tried at all.
+    """
+
+    def __init__(self, attempts=1, backoff=1.0, max_backoff=30.0, breaker=None):
+        self.attempts = max(attempts, 1)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker
+
+    def delay(self, attempt):
+        """Seconds to wait before attempt 'attempt' + 1"""
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return delay * random.uniform(0.5, 1)
+
+    def deadline(self, timeout, requests=1):
+        """Seconds 'requests' requests of up to 'timeout' seconds each
+        may take with all attempts and backoff"""
+        backoff = sum(min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+                      for attempt in range(1, self.attempts))
+        return requests * (self.attempts * timeout + backoff)
+
+    def retryable(self, error, idempotent):
+        if isinstance(error, (amt_connect_error, amt_busy_error)):
+            return True
+        return idempotent and type(error) is amt_connection_error
+
+    def run(self, endpoint, send, idempotent=False, transient=None,
+            metrics=None):
+        """Return the response from send(), which raises amt_error if
+        there is none; for idempotent requests, responses for which
+        transient() is true are retried as well"""
+        breaker = self.breaker
+        attempt = 1
+        while True:
+            if breaker is not None:
+                breaker.admit(endpoint)
+            try:
+                result = send()
+            except amt_error as e:
+                if breaker is not None and isinstance(e, amt_connection_error):
+                    breaker.failure(endpoint)
+                elif breaker is not None:
+                    breaker.success(endpoint)
+                if attempt >= self.attempts or not self.retryable(e, idempotent):
+                    raise
+                reason = e.kind
+            else:
+                if breaker is not None:
+                    breaker.success(endpoint)
+                if attempt >= self.attempts or not idempotent or \
+                   transient is None or not transient(result):
+                    return result
+                reason = 'transient fault'
+            if metrics is not None:
+                metrics.retry(endpoint, reason)
+            time.sleep(self.delay(attempt))
+            attempt += 1
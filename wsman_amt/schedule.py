@@ -0,0 +1,174 @@
+"""Admission control for rolling operations across a fleet and for
+the requests to each host"""
+
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+class token_bucket:
+    """Allow 'rate' operations per second on average with bursts of up
+    to 'burst' operations"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until the next token is available"""
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class rolling_scheduler:
+    """Decide when the next operation of a group may start
+
+    At most 'concurrency' operations run in total and 'group_limit'
+    per group (a rack or PDU), starts are limited by a token bucket of
+    'rate' per second, and consecutive starts within one group are
+    'stagger' seconds apart. A limit of 0 or None disables it.
+    start() is called by the dispatcher, finish() from the workers.
+    """
+
+    def __init__(self, concurrency, group_limit=None, rate=None, burst=1,
+                 stagger=None):
+        self.concurrency = concurrency
+        self.group_limit = group_limit
+        self.bucket = token_bucket(rate, burst) if rate else None
+        self.stagger = stagger
+        self.lock = threading.Lock()
+        self.running = 0
+        self.group_running = {}
+        self.group_started = {}
+
+    def delay(self, group):
+        """Seconds until an operation of 'group' may start, or None if
+        that depends on another one finishing"""
+        now = time.monotonic()
+        with self.lock:
+            if self.concurrency and self.running >= self.concurrency:
+                return None
+            if self.group_limit and \
+               self.group_running.get(group, 0) >= self.group_limit:
+                return None
+            wait = 0
+            if self.stagger and group in self.group_started:
+                wait = self.group_started[group] + self.stagger - now
+            if self.bucket is not None:
+                wait = max(wait, self.bucket.delay(now))
+            return max(wait, 0)
+
+    def start(self, group):
+        with self.lock:
+            self.running += 1
+            self.group_running[group] = self.group_running.get(group, 0) + 1
+            self.group_started[group] = time.monotonic()
+            if self.bucket is not None:
+                self.bucket.take()
+
+    def finish(self, group):
+        with self.lock:
+            self.running -= 1
+            self.group_running[group] -= 1
+
+class endpoint_state:
+    def __init__(self, limit):
+        self.slots = threading.BoundedSemaphore(limit)
+        self.writable = threading.Condition()
+        self.writer = None
+        self.depth = 0
+        self.reads = {}
+
+class host_scheduler:
+    """Order the WS-Man requests of sessions to the same endpoints
+
+    At most 'limit' requests run against an endpoint at a time.
+    Read-modify-write sequences run within write(), one at a time per
+    endpoint, so their Get and Put or Invoke do not interleave with
+    those of another sequence. Identical Get requests in flight are
+    merged into one, except within write(), which needs a response
+    from after the previous sequence. A single instance is shared by
+    the sessions of all threads.
+    """
+
+    def __init__(self, limit=2):
+        self.limit = max(limit, 1)
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.merged = 0
+
+    def state(self, endpoint):
+        with self.lock:
+            state = self.endpoints.get(endpoint)
+            if state is None:
+                state = self.endpoints[endpoint] = endpoint_state(self.limit)
+            return state
+
+    @contextmanager
+    def slot(self, endpoint):
+        """Hold one of the request slots of 'endpoint'"""
+        with self.state(endpoint).slots:
+            yield
+
+    @contextmanager
+    def write(self, endpoint):
+        """Run a read-modify-write sequence on 'endpoint'; nests within
+        one thread"""
+        state = self.state(endpoint)
+        me = threading.get_ident()
+        with state.writable:
+            while state.writer not in (None, me):
+                state.writable.wait()
+            state.writer = me
+            state.depth += 1
+        try:
+            yield
+        finally:
+            with state.writable:
+                state.depth -= 1
+                if not state.depth:
+                    state.writer = None
+                    state.writable.notify()
+
+    def read(self, endpoint, key, fetch):
+        """Return the result of fetch(), which takes a slot, for the
+        Get request 'key', and whether it went to other callers as
+        well; callers which find the same request in flight wait for
+        its result"""
+        state = self.state(endpoint)
+        if state.writer == threading.get_ident():
+            return fetch(), False
+        with self.lock:
+            pending = state.reads.get(key)
+            leader = pending is None
+            if leader:
+                # The result and the number of callers waiting for it
+                pending = state.reads[key] = [Future(), 0]
+            else:
+                pending[1] += 1
+                self.merged += 1
+        if not leader:
+            return pending[0].result(), True
+        try:
+            result = fetch()
+        except BaseException as e:
+            with self.lock:
+                del state.reads[key]
+            pending[0].set_exception(e)
+            raise
+        with self.lock:
+            del state.reads[key]
+            shared = pending[1] > 0
+        pending[0].set_result(result)
+        return result, shared
@@ -0,0 +1,341 @@
+"""Long-running HTTP/JSON interface to wsman_amt
+
+Keeps a wsman_amt session per host open between requests, so that
+callers skip process startup, the transport import and the digest
+handshake:
+
+    GET  /hosts/<host>/status[?all=1]
+    GET  /hosts/<host>/identify
+    GET  /hosts/<host>/<command>
+    POST /hosts/<host>/<command>   {"action": "enable"}
+
+Commands are power, serial, ider, listener and kvm; POST to power
+also takes "wait" in seconds. Responses are the JSON records of the
+fleet output.
+"""
+
+import json
+import os
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from .amt import wsman_amt
+from .errors import amt_error, amt_connection_error, amt_busy_error, \
+    amt_unavailable_error
+from .fleet import fleet_job
+
+def query_flag(query, name):
+    return query.get(name, [''])[0].lower() in ('1', 'true', 'yes')
+
+def choose(action, choices):
+    if action not in choices:
+        raise ValueError(f'Invalid action {action}, must be one of {", ".join(choices)}')
+    return action
+
+def seconds(value):
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+       not 0 <= value < float('inf'):
+        raise ValueError(f'Invalid wait {value!r}, must be a non-negative number of seconds')
+    return value
+
+# command: (GET, POST); GET gets the parsed query string, POST the
+# request body
+server_command_map = {
+    'identify': (lambda a, q: a.identify(), None),
+    'status': (lambda a, q: a.get_status(query_flag(q, 'all')), None),
+    'power': (lambda a, q: a.get_powerstate(),
+              lambda a, b: a.set_powerstate(b.get('action'), seconds(b.get('wait')))),
+    'serial': (lambda a, q: a.get_redirection(),
+               lambda a, b: a.set_redirection(
+                   choose(b.get('action'), ('enable', 'disable')), None)),
+    'ider': (lambda a, q: a.get_redirection(),
+             lambda a, b: a.set_redirection(
+                 None, choose(b.get('action'), ('enable', 'disable')))),
+    'listener': (lambda a, q: a.get_redirection(),
+                 lambda a, b: a.set_redirection_listener(b.get('action'))),
+    'kvm': (lambda a, q: a.kvm_redirection('status'),
+            lambda a, b: a.start_kvm_redirection()
+            if b.get('action') == 'start' else
+            a.kvm_redirection(choose(b.get('action'), ('enable', 'disable')))),
+}
+
+class pooled_host:
+    def __init__(self):
+        self.idle = []
+        self.count = 0
+        self.users = 0
+        self.used = time.monotonic()
+
+class session_pool:
+    """wsman_amt sessions by host in least recently used order
+
+    Each session serves one request at a time, and up to 'per_host'
+    are opened for concurrent requests to the same host. Beyond
+    'max_hosts', and after 'idle' seconds without use, the sessions
+    of idle hosts are closed; one which lost its connection is
+    replaced on the next request.
+    """
+
+    def __init__(self, connect, max_hosts=64, idle=300, per_host=1):
+        self.connect = connect
+        self.max_hosts = max_hosts
+        self.idle = idle
+        self.per_host = max(per_host, 1)
+        self.ready = threading.Condition()
+        self.hosts = OrderedDict()
+        self.opened = 0
+        self.reused = 0
+
+    def expire(self):
+        """Remove the sessions to close from the pool; returns them"""
+        now = time.monotonic()
+        expired = []
+        excess = len(self.hosts) - self.max_hosts
+        for host, entry in list(self.hosts.items()):
+            if entry.users:
+                continue
+            if excess > 0 or now - entry.used > self.idle:
+                del self.hosts[host]
+                expired.extend(entry.idle)
+                excess -= 1
+        return expired
+
+    @contextmanager
+    def session(self, host):
+        with self.ready:
+            entry = self.hosts.get(host)
+            if entry is None:
+                entry = self.hosts[host] = pooled_host()
+            self.hosts.move_to_end(host)
+            entry.users += 1
+            while not entry.idle and entry.count >= self.per_host:
+                self.ready.wait()
+            if entry.idle:
+                amt = entry.idle.pop()
+                self.reused += 1
+            else:
+                amt = self.connect(host)
+                entry.count += 1
+                self.opened += 1
+            expired = self.expire()
+        for a in expired:
+            a.close()
+        failed = False
+        try:
+            yield amt
+        except amt_connection_error:
+            failed = True
+            raise
+        finally:
+            with self.ready:
+                entry.users -= 1
+                entry.used = time.monotonic()
+                if failed:
+                    entry.count -= 1
+                else:
+                    entry.idle.append(amt)
+                self.ready.notify_all()
+            if failed:
+                amt.close()
+
+    def close(self):
+        with self.ready:
+            entries = list(self.hosts.values())
+            self.hosts.clear()
+        for entry in entries:
+            for a in entry.idle:
+                a.close()
+
+class amt_server:
+    """Run wsman_amt operations for API requests on pooled sessions
+
+    Concurrent GET requests with the same host, command and query
+    share one operation and its result. Requests to one host run on
+    up to args.host_concurrency sessions, ordered by args.scheduler.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.pool = session_pool(self.connect, args.max_hosts, args.idle,
+                                 args.host_concurrency)
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.requests = 0
+        self.coalesced = 0
+
+    def connect(self, host):
+        args = self.args
+        return wsman_amt(host, args.username, args.password, args.port,
+                         args.timeout, args.transport, args.cache, args.metrics,
+                         args.scheduler, args.retry)
+
+    def run(self, host, func, arg):
+        """Run 'func' on the session of 'host'; returns the HTTP status
+        and the job record"""
+        job = fleet_job(host)
+        job.started = time.monotonic()
+        code = 200
+        try:
+            with self.pool.session(host) as a:
+                a.out = job.output
+                a.debug(self.args.debug)
+                job.result = func(a, arg)
+            job.status = 'ok' if job.result is None or job.result.ok else 'failed'
+        except ValueError as e:
+            code = 400
+            job.status = 'failed'
+            job.error = str(e)
+            job.error_kind = 'invalid'
+        except amt_error as e:
+            # Busy or skipped hosts may be asked again later
+            code = 503 if isinstance(e, (amt_busy_error, amt_unavailable_error)) else 502
+            job.status = 'failed'
+            job.error = str(e)
+            job.error_kind = e.kind
+        except Exception as e:
+            code = 500
+            job.status = 'failed'
+            job.error = repr(e)
+        job.elapsed = time.monotonic() - job.started
+        return code, job.record()
+
+    def get(self, host, command, query):
+        key = (host, command, tuple(sorted((k, tuple(v)) for k, v in query.items())))
+        with self.lock:
+            self.requests += 1
+            future = self.inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                owner = False
+            else:
+                future = self.inflight[key] = Future()
+                owner = True
+        if not owner:
+            return future.result()
+        try:
+            result = self.run(host, server_command_map[command][0], query)
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+        return result
+
+    def post(self, host, command, body):
+        with self.lock:
+            self.requests += 1
+        return self.run(host, server_command_map[command][1], body)
+
+    def stats(self):
+        return (f'{self.requests} requests, {self.coalesced} coalesced, '
+                f'{self.pool.opened} sessions opened, {self.pool.reused} reused')
+
+    def handler(self):
+        server = self
+
+        class handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def reply(self, code, data, content_type='application/json'):
+                if content_type == 'application/json':
+                    data = json.dumps(data) + '\n'
+                body = data.encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def route(self, method):
+                """Return host, command and query string of the request,
+                or None after replying with an error"""
+                url = urlsplit(self.path)
+                parts = url.path.strip('/').split('/')
+                if len(parts) != 3 or parts[0] != 'hosts' or \
+                   parts[2] not in server_command_map:
+                    self.reply(404, {'error': f'Unknown resource {url.path}'})
+                    return None
+                if server_command_map[parts[2]][method] is None:
+                    self.reply(405, {'error': f'{parts[2]} is read-only'})
+                    return None
+                return unquote(parts[1]), parts[2], parse_qs(url.query)
+
+            def do_GET(self):
+                if self.path == '/metrics' and server.args.metrics is not None:
+                    self.reply(200, server.args.metrics.openmetrics(),
+                               'application/openmetrics-text; version=1.0.0; charset=utf-8')
+                    return
+                route = self.route(0)
+                if route is not None:
+                    self.reply(*server.get(*route))
+
+            def do_POST(self):
+                route = self.route(1)
+                if route is None:
+                    return
+                host, command, query = route
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    body = json.loads(self.rfile.read(length) or b'{}')
+                    if not isinstance(body, dict):
+                        raise ValueError('Request body must be a JSON object')
+                except ValueError as e:
+                    self.reply(400, {'error': f'Invalid request: {e}'})
+                    return
+                self.reply(*server.post(host, command, body))
+
+            def address_string(self):
+                # Unix socket peers have no address
+                if isinstance(self.client_address, tuple):
+                    return self.client_address[0]
+                return 'local'
+
+            def log_message(self, format, *args):
+                if server.args.debug:
+                    super().log_message(format, *args)
+
+        return handler
+
+class unix_http_server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # Replace the socket of a previous run
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+def serve(args):
+    """Answer API requests on args.socket or args.listen until
+    interrupted"""
+    server = amt_server(args)
+    if args.socket:
+        httpd = unix_http_server(args.socket, server.handler())
+        where = args.socket
+    else:
+        address, _, port = args.listen.rpartition(':')
+        httpd = ThreadingHTTPServer((address or '127.0.0.1', int(port)),
+                                    server.handler())
+        httpd.daemon_threads = True
+        where = f'http://{httpd.server_address[0]}:{httpd.server_address[1]}'
+    print(f'Serving on {where}', flush=True)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        server.pool.close()
+        if args.socket:
+            os.unlink(args.socket)
+    print(server.stats())
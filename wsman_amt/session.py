@@ -0,0 +1,455 @@
+"""Persistent WS-Man session for one AMT endpoint"""
+
+import importlib
+import importlib.util
+import time
+from contextlib import nullcontext
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit
+
+from .errors import amt_connection_error, amt_connect_error, \
+    amt_timeout_error, amt_auth_error, amt_busy_error, amt_response_error, \
+    amt_fault
+from .retry import retry_policy
+from .soap import XML_NS_ENUMERATION, XML_NS_WS_MAN, wsman_doc, \
+    wsman_item_parser
+
+# Determined without importing, pywsman is slow to load
+if importlib.util.find_spec('pywsman') is not None:
+    default_transport = 'pywsman'
+else:
+    default_transport = 'async'
+
+# Requests are sent once unless a retry_policy is passed
+no_retry = retry_policy()
+
+class wsman_session:
+    """Persistent WS-Man client for one AMT endpoint
+
+    The underlying client is created on first use and kept until
+    close(), so consecutive requests reuse the same keep-alive HTTP
+    connection and the digest-auth state negotiated on it.
+    'transport' selects the backend, either the 'pywsman' bindings
+    or the pure-Python 'async' implementation; its module is only
+    imported on the first request.
+    With a wsman_cache, Get requests made with 'cached' are served from
+    the cache while valid, and Put or Invoke on a resource invalidate
+    its entry; other Get requests go to the endpoint and refresh it.
+    With a wsman_metrics, the latency of each request is recorded by
+    resource and operation, as are faults, requests without response
+    and cache hits.
+    With a host_scheduler, requests take one of the endpoint's slots,
+    identical Get requests in flight are merged, and callers run
+    read-modify-write sequences within exclusive().
+    Requests are retried as the retry_policy 'retry' allows.
+    Requests without a response raise amt_connect_error if no
+    connection could be made, amt_auth_error for wrong credentials,
+    amt_timeout_error if the response did not come in time, and
+    amt_connection_error otherwise.
+    """
+
+    # Enumerate and Pull responses are parsed in pieces of this size
+    parse_chunk = 16384
+    # openwsman last_error() codes: COULDNT_RESOLVE_HOST and
+    # COULDNT_CONNECT, OPERATION_TIMEOUTED, LOGIN_DENIED
+    pywsman_error_map = { 6: 'connect', 7: 'connect', 12: 'timeout',
+                          27: 'auth' }
+    error_kind_map = { 'connect': amt_connect_error,
+                       'timeout': amt_timeout_error }
+
+    def __init__(self, url, timeout=None, transport=None, cache=None,
+                 metrics=None, scheduler=None, retry=None):
+        u = urlsplit(url)
+        self.url = url
+        self.endpoint = f'{u.hostname}:{u.port}'
+        self.timeout = timeout
+        self.transport = transport or default_transport
+        self.cache = cache
+        self.metrics = metrics
+        self.scheduler = scheduler
+        self.retry = retry or no_retry
+        self.client = None
+        self.pywsman = None
+        self.pywsman_options = None
+
+    def connect(self):
+        if self.client is None and self.transport == 'async':
+            from .transport import wsman_sync_client
+            self.client = wsman_sync_client( self.url, self.timeout,
+                                             self.metrics )
+        elif self.client is None:
+            self.pywsman = importlib.import_module('pywsman')
+            client = self.pywsman.Client( self.url )
+            if client is None:
+                raise amt_connection_error(f'{self.endpoint}: cannot create client')
+            transport = client.transport()
+            # Skip the basic-auth probe, AMT only does digest
+            transport.set_auth_method( self.pywsman.DIGEST_AUTH_STR )
+            if self.timeout:
+                transport.set_timeout( int(self.timeout) )
+            self.client = client
+        return self.client
+
+    def abort(self):
+        """Make the request in progress and all further ones fail, from
+        any thread; pywsman requests cannot be interrupted and run to
+        completion"""
+        if self.client is not None and self.transport == 'async':
+            self.client.abort()
+
+    def close(self):
+        if self.client is not None and self.transport == 'async':
+            self.client.close()
+        # Dropping the pywsman Client releases its connection
+        self.client = None
+
+    def native_options(self, options):
+        """Translate wsman_options for the pywsman backend"""
+        if self.transport == 'async':
+            return options
+        if self.pywsman_options is None:
+            self.pywsman_options = self.pywsman.ClientOptions()
+            if options.dump_request:
+                self.pywsman_options.set_dump_request()
+        return self.pywsman_options
+
+    def native_doc(self, data):
+        """Translate a wsman_doc method input for the pywsman backend"""
+        if self.transport == 'async' or not isinstance(data, wsman_doc):
+            return data
+        return self.pywsman.create_doc_from_string( data.__str__() )
+
+    def check(self, doc, what):
+        if doc is None:
+            error = None
+            if hasattr(self.client, 'last_error'):
+                error = self.client.last_error()
+            if self.transport == 'async':
+                kind = self.client.last_error_kind()
+            elif hasattr(self.client, 'response_code') and \
+                 self.client.response_code() == 401:
+                kind = 'auth'
+            else:
+                kind = self.pywsman_error_map.get(error)
+            if kind == 'auth':
+                raise amt_auth_error(f'{self.endpoint}: authentication failed')
+            msg = f'{self.endpoint}: no response to {what}'
+            if kind == 'timeout' and self.timeout:
+                msg += f' within {self.timeout:g}s'
+            elif error:
+                msg += f' ({error})'
+            raise self.error_kind_map.get(kind, amt_connection_error)(msg)
+        return doc
+
+    def record(self, uri, op, start, doc):
+        """Account the request for 'op' on 'uri' started at 'start'
+        which returned 'doc'"""
+        if self.metrics is None:
+            return
+        resource = uri.rpartition('/')[2]
+        if doc is None:
+            self.metrics.error( self.endpoint, resource )
+            return
+        self.metrics.request( self.endpoint, resource, op,
+                              time.perf_counter() - start )
+        if not isinstance(doc, bytes) and doc.is_fault():
+            self.record_fault( resource, doc.fault() )
+
+    def record_fault(self, resource, fault):
+        if self.metrics is not None:
+            # The subcode names the kind of fault, the reason varies
+            reason = fault.subcode() or fault.reason() or 'unknown'
+            self.metrics.fault( self.endpoint, resource,
+                                reason.rpartition(':')[2] )
+
+    def parse(self, xml):
+        if self.transport == 'async':
+            return wsman_doc.parse( xml )
+        return self.pywsman.create_doc_from_string( xml )
+
+    def cached(self, uri):
+        if self.cache is None:
+            return None
+        xml = self.cache.get( self.endpoint, uri )
+        if xml is None:
+            return None
+        if self.metrics is not None:
+            self.metrics.cache_hit( self.endpoint, uri.rpartition('/')[2] )
+        self.connect()
+        # Callers modify documents, so hand out a fresh copy
+        return self.parse( xml )
+
+    def store(self, uri, doc):
+        if self.cache is not None and not doc.is_fault():
+            self.cache.put( self.endpoint, uri, doc.__str__() )
+
+    def invalidate(self, uri):
+        if self.cache is not None:
+            self.cache.invalidate( self.endpoint, uri )
+
+    def slot(self):
+        """Context holding a request slot of the endpoint"""
+        if self.scheduler is None:
+            return nullcontext()
+        return self.scheduler.slot( self.endpoint )
+
+    def exclusive(self):
+        """Context in which a read-modify-write sequence runs without
+        those of other sessions to the endpoint"""
+        if self.scheduler is None:
+            return nullcontext()
+        return self.scheduler.write( self.endpoint )
+
+    def run(self, send, idempotent, transient=None):
+        """Return the response of send(), a single attempt, retried as
+        the retry policy allows"""
+        return self.retry.run( self.endpoint, send, idempotent, transient,
+                               self.metrics )
+
+    def timed_out(self, doc):
+        """Whether 'doc' is a TimedOut fault, which AMT sends when it
+        cannot serve the request in time"""
+        return doc.is_fault() and \
+            (doc.fault().subcode() or '').endswith('TimedOut')
+
+    def busy(self, uri, doc):
+        """Whether the method output 'doc' reports the firmware busy"""
+        if doc.is_fault():
+            return False
+        value = doc.root().find( uri, 'ReturnValue' )
+        return value is not None and value.__str__() == '4099'
+
+    def identify(self, options):
+        client = self.connect()
+
+        def send():
+            with self.slot():
+                start = time.perf_counter()
+                doc = client.identify( self.native_options(options) )
+                self.record( 'Identify', 'Identify', start, doc )
+            return self.check( doc, 'Identify' )
+
+        return self.run( send, True, self.timed_out )
+
+    def fetch(self, options, uri):
+        client = self.connect()
+
+        def send():
+            with self.slot():
+                start = time.perf_counter()
+                doc = client.get( self.native_options(options), uri )
+                self.record( uri, 'Get', start, doc )
+            return self.check( doc, uri )
+
+        return self.run( send, True, self.timed_out )
+
+    def get(self, options, uri, cached=False):
+        doc = self.cached( uri ) if cached else None
+        if doc is not None:
+            return doc
+        if self.scheduler is None:
+            doc = self.fetch( options, uri )
+        else:
+            doc, shared = self.scheduler.read( self.endpoint, uri,
+                                               lambda: self.fetch( options, uri ) )
+            if shared:
+                # Callers modify documents, so each gets its own copy
+                self.connect()
+                doc = self.parse( doc.__str__() )
+        self.store( uri, doc )
+        return doc
+
+    def put(self, options, uri, data, size=None, encoding='utf-8'):
+        """Put 'data', a document or its serialization; documents are
+        only serialized by the transport"""
+        self.invalidate( uri )
+        client = self.connect()
+        if self.transport != 'async' and not isinstance(data, (str, bytes)):
+            # The pywsman Put takes a string
+            data = data.__str__()
+            size = len(data)
+
+        def send():
+            with self.slot():
+                start = time.perf_counter()
+                doc = client.put( self.native_options(options), uri, data,
+                                  size, encoding )
+                self.record( uri, 'Put', start, doc )
+            return self.check( doc, uri )
+
+        # Putting the same document again does no harm
+        return self.run( send, True, self.timed_out )
+
+    def invoke(self, options, uri, method, data):
+        """Invoke 'method'; raises amt_busy_error if the firmware is
+        busy"""
+        self.invalidate( uri )
+        client = self.connect()
+        data = self.native_doc(data)
+
+        def send():
+            with self.slot():
+                start = time.perf_counter()
+                doc = client.invoke( self.native_options(options), uri,
+                                     method, data )
+                self.record( uri, method, start, doc )
+            self.check( doc, f'{uri} {method}' )
+            if self.busy( uri, doc ):
+                raise amt_busy_error(f'{self.endpoint}: {uri.rpartition("/")[2]} '
+                                     f'{method} failed, firmware busy')
+            return doc
+
+        return self.run( send, False )
+
+    def page(self, options, uri, context, max_elements):
+        """Return the undecoded Enumerate response, or the Pull
+        response for 'context'"""
+        client = self.connect()
+        op = 'Pull' if context else 'Enumerate'
+
+        def send():
+            with self.slot():
+                start = time.perf_counter()
+                if self.transport == 'async':
+                    if context is None:
+                        data = client.enumerate( options, uri, max_elements )
+                    else:
+                        data = client.pull( options, uri, context, max_elements )
+                else:
+                    o = self.pywsman.ClientOptions()
+                    if options.dump_request:
+                        o.set_dump_request()
+                    o.set_flags( self.pywsman.FLAG_ENUMERATION_OPTIMIZATION )
+                    o.set_max_elements( max_elements )
+                    if context is None:
+                        doc = client.enumerate( o, None, uri )
+                    else:
+                        doc = client.pull( o, None, uri, context )
+                    data = doc.__str__().encode('utf-8') if doc is not None else None
+                self.record( uri, op, start, data )
+            return self.check( data, f'{uri} {op}' )
+
+        # A repeated Pull may have lost the instances of the first one
+        return self.run( send, context is None )
+
+    def release(self, options, uri, context):
+        client = self.connect()
+        with self.slot():
+            if self.transport == 'async':
+                client.release( options, uri, context )
+            else:
+                client.release( self.native_options(options), uri, context )
+
+    def enumerate(self, options, uri, max_elements=32):
+        """Yield the instances of 'uri' as XML nodes, fetched with
+        Enumerate and Pull of up to 'max_elements' at a time
+
+        Each response is parsed while instances are handed out, so
+        memory use is bounded by one response however large the
+        collection. Faults raise amt_fault and malformed responses
+        amt_response_error; an enumeration abandoned early is released
+        on the endpoint.
+        """
+        context = None
+        data = None
+        try:
+            while True:
+                pending, context = context, None
+                data = self.page( options, uri, pending, max_elements )
+                parser = wsman_item_parser()
+                for i in range(0, len(data), self.parse_chunk):
+                    yield from parser.feed( data[i:i + self.parse_chunk] )
+                doc = parser.close()
+                data = None
+                context = self.next_context( uri, doc )
+                if context is None:
+                    return
+        except ET.ParseError as e:
+            data = None
+            raise amt_response_error(f'{uri}: invalid response, {e}')
+        finally:
+            if data is not None:
+                # Abandoned within a response, which holds the context
+                parser = wsman_item_parser()
+                try:
+                    for _ in parser.feed( data ):
+                        pass
+                    context = self.next_context( uri, parser.close() )
+                except (amt_fault, ET.ParseError):
+                    pass
+            if context is not None:
+                self.release( options, uri, context )
+
+    def next_context(self, uri, doc):
+        """Return the EnumerationContext for the next Pull after the
+        Enumerate or Pull response 'doc', None at the end"""
+        if doc.is_fault():
+            self.record_fault( uri.rpartition('/')[2], doc.fault() )
+            raise amt_fault(uri, doc.fault())
+        root = doc.root()
+        if (root.find( XML_NS_ENUMERATION, 'EndOfSequence' ) is not None or
+            root.find( XML_NS_WS_MAN, 'EndOfSequence' ) is not None):
+            return None
+        node = root.find( XML_NS_ENUMERATION, 'EnumerationContext' )
+        if node is None or not str(node):
+            return None
+        return str(node)
+
+    def pipeline(self, options, requests, cached=False):
+        """Run a batch of ('get', uri)-style requests, pipelined if the
+        transport supports it; returns the documents in order. With
+        'cached' Get requests are served from the cache while valid."""
+        docs = [None] * len(requests)
+        pending = []
+        for i, r in enumerate(requests):
+            if r[0] == 'get' and cached:
+                docs[i] = self.cached( r[1] )
+            elif r[0] in ('put', 'invoke'):
+                self.invalidate( r[1] )
+            if docs[i] is None:
+                pending.append(i)
+        if not pending:
+            return docs
+        client = self.connect()
+        options = self.native_options(options)
+        batch = [requests[i] for i in pending]
+
+        def send():
+            with self.slot():
+                start = time.perf_counter()
+                if hasattr(client, 'pipeline'):
+                    results = client.pipeline( options, batch )
+                else:
+                    results = [getattr(client, r[0])( options, *r[1:] )
+                               for r in batch]
+            if self.metrics is not None:
+                # Pipelined requests are only timed as a batch
+                names = [r[1].rpartition('/')[2] if len(r) > 1 else 'Identify'
+                         for r in batch]
+                resource = ','.join(names)
+                if None in results:
+                    self.metrics.error( self.endpoint, resource )
+                else:
+                    self.metrics.request( self.endpoint, resource, 'Pipeline',
+                                          time.perf_counter() - start )
+                for name, doc in zip(names, results):
+                    if doc is not None and doc.is_fault():
+                        self.record_fault( name, doc.fault() )
+            for r, doc in zip(batch, results):
+                self.check( doc, r[1] if len(r) > 1 else r[0] )
+            return results
+
+        idempotent = all(r[0] in ('get', 'identify') for r in batch)
+        results = self.run( send, idempotent,
+                            lambda results: any(map(self.timed_out, results)) )
+        for i, doc in zip(pending, results):
+            if requests[i][0] == 'get':
+                self.store( requests[i][1], doc )
+            docs[i] = doc
+        return docs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
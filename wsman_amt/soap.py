@@ -0,0 +1,202 @@
+"""WS-Man namespaces and a pure-Python stand-in for the pywsman XML API"""
+
+import xml.etree.ElementTree as ET
+
+# WS-Man namespaces, same values as exported by pywsman
+XML_NS_SOAP_1_2 = 'http://www.w3.org/2003/05/soap-envelope'
+XML_NS_ADDRESSING = 'http://schemas.xmlsoap.org/ws/2004/08/addressing'
+XML_NS_TRANSFER = 'http://schemas.xmlsoap.org/ws/2004/09/transfer'
+XML_NS_ENUMERATION = 'http://schemas.xmlsoap.org/ws/2004/09/enumeration'
+XML_NS_WS_MAN = 'http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd'
+XML_NS_WSMAN_ID = 'http://schemas.dmtf.org/wbem/wsman/identity/1/wsmanidentity.xsd'
+XML_NS_CIM_CLASS = 'http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2'
+WSA_TO_ANONYMOUS = 'http://schemas.xmlsoap.org/ws/2004/08/addressing/role/anonymous'
+
+XML_NS_AMT_CLASS = 'http://intel.com/wbem/wscim/1/amt-schema/1'
+XML_NS_IPS_CLASS = 'http://intel.com/wbem/wscim/1/ips-schema/1'
+
+for prefix, ns in [('s', XML_NS_SOAP_1_2), ('wsa', XML_NS_ADDRESSING),
+                   ('wsman', XML_NS_WS_MAN), ('wsmid', XML_NS_WSMAN_ID),
+                   ('wxf', XML_NS_TRANSFER), ('wsen', XML_NS_ENUMERATION)]:
+    ET.register_namespace(prefix, ns)
+
+def xml_tag(ns, name):
+    if ns is None:
+        return name
+    return '{' + ns + '}' + name
+
+class wsman_node:
+    """XML element with the subset of the pywsman XmlNode interface
+    used by wsman_amt"""
+
+    def __init__(self, elem):
+        self.elem = elem
+
+    def __str__(self):
+        return self.elem.text or ''
+
+    def string(self):
+        return self.__str__()
+
+    def __iter__(self):
+        return (wsman_node(e) for e in self.elem)
+
+    def name(self):
+        return self.elem.tag.rpartition('}')[2]
+
+    def ns(self):
+        if self.elem.tag.startswith('{'):
+            return self.elem.tag[1:].partition('}')[0]
+        return None
+
+    def set_text(self, text):
+        self.elem.text = text
+
+    def find(self, ns, name, recursive=True):
+        tag = xml_tag(ns, name)
+        if recursive:
+            elems = self.elem.iter(tag)
+        else:
+            elems = self.elem.iterfind(tag)
+        for e in elems:
+            if e is not self.elem:
+                return wsman_node(e)
+        return None
+
+    def add(self, ns, name, text=None):
+        e = ET.SubElement(self.elem, xml_tag(ns, name))
+        if text:
+            e.text = text
+        return wsman_node(e)
+
+    def attr_add(self, ns, name, value):
+        self.elem.set(xml_tag(ns, name), value)
+
+class wsman_fault:
+    """SOAP fault of a wsman_doc"""
+
+    def __init__(self, node):
+        self.node = node
+
+    def _find(self, *names):
+        node = self.node
+        for name in names:
+            node = node.find(XML_NS_SOAP_1_2, name, False)
+            if node is None:
+                return None
+        return str(node)
+
+    def code(self):
+        return self._find('Code', 'Value')
+
+    def subcode(self):
+        return self._find('Code', 'Subcode', 'Value')
+
+    def reason(self):
+        return self._find('Reason', 'Text')
+
+    def detail(self):
+        return self._find('Detail')
+
+class wsman_doc:
+    """XML document with the subset of the pywsman XmlDoc interface
+    used by wsman_amt"""
+
+    def __init__(self, name, ns=None):
+        if isinstance(name, ET.Element):
+            self.elem = name
+        else:
+            self.elem = ET.Element(xml_tag(ns, name))
+
+    @classmethod
+    def parse(cls, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return cls(ET.fromstring(data))
+
+    def __str__(self):
+        return ET.tostring(self.elem, encoding='unicode')
+
+    def root(self):
+        return wsman_node(self.elem)
+
+    def body(self):
+        return self.root().find(XML_NS_SOAP_1_2, 'Body', False)
+
+    def is_fault(self):
+        return self.fault() is not None
+
+    def fault(self):
+        body = self.body()
+        if body is None:
+            return None
+        f = body.find(XML_NS_SOAP_1_2, 'Fault', False)
+        if f is None:
+            return None
+        return wsman_fault(f)
+
+class wsman_doc_parser:
+    """Build a wsman_doc from a response as it is read"""
+
+    def __init__(self):
+        self.parser = ET.XMLParser()
+        self.size = 0
+
+    def feed(self, data):
+        self.parser.feed(data)
+        self.size += len(data)
+
+    def close(self):
+        return wsman_doc(self.parser.close())
+
+class wsman_options:
+    """Client options with the subset of the pywsman ClientOptions
+    interface used by wsman_amt"""
+
+    def __init__(self):
+        self.dump_request = False
+        self.dump_file = None
+
+    def set_dump_request(self, file=None):
+        """Print requests to 'file', stdout by default"""
+        self.dump_request = True
+        self.dump_file = file
+
+class wsman_item_parser:
+    """Incremental parser for Enumerate and Pull responses
+
+    feed() returns the instances in the Items of the response as
+    soon as they are complete, each detached from the document so
+    that only the instance being parsed is held in memory. close()
+    returns what remains of the response as a wsman_doc, for faults,
+    the EnumerationContext and EndOfSequence.
+    """
+
+    def __init__(self):
+        self.parser = ET.XMLPullParser(('start', 'end'))
+        self.stack = []
+        self.root = None
+
+    def feed(self, data):
+        self.parser.feed(data)
+        return self.items()
+
+    def items(self):
+        for event, elem in self.parser.read_events():
+            if event == 'start':
+                if self.root is None:
+                    self.root = elem
+                self.stack.append(elem)
+                continue
+            self.stack.pop()
+            if self.stack and self.stack[-1].tag in (
+                    xml_tag(XML_NS_ENUMERATION, 'Items'),
+                    xml_tag(XML_NS_WS_MAN, 'Items')):
+                self.stack[-1].remove(elem)
+                yield wsman_node(elem)
+
+    def close(self):
+        self.parser.close()
+        for _ in self.items():
+            pass
+        return wsman_doc(self.root)
@@ -0,0 +1,145 @@
+"""Serial-over-LAN console through the AMT redirection protocol"""
+
+import asyncio
+import os
+import struct
+import sys
+
+from .redirect import redirection_protocol, redirection_connect
+
+START_SOL_REDIRECTION = 0x20
+START_SOL_REDIRECTION_REPLY = 0x21
+END_SOL_REDIRECTION_REPLY = 0x23
+SOL_KEEP_ALIVE_PING = 0x24
+SOL_DATA_TO_HOST = 0x28
+SOL_CONTROLS_FROM_HOST = 0x29
+SOL_DATA_FROM_HOST = 0x2A
+SOL_HEARTBEAT = 0x2B
+
+# The host sends at most this many bytes per message
+SOL_MAX_TRANSMIT_BUFFER = 1000
+SOL_HEARTBEAT_INTERVAL = 5
+
+class sol_protocol(redirection_protocol):
+    """Serial-over-LAN session
+
+    Console bytes are handed to 'sink', a callable taking a
+    memoryview, straight out of the fixed receive buffer; the view is
+    only valid during the call. Console data is forwarded as it
+    arrives, so the buffer only has to hold one control message.
+    """
+
+    session_type = b'SOL '
+    message_size_map = { START_SOL_REDIRECTION_REPLY: 23,
+                         END_SOL_REDIRECTION_REPLY: 8,
+                         SOL_KEEP_ALIVE_PING: 8,
+                         SOL_CONTROLS_FROM_HOST: 10,
+                         SOL_HEARTBEAT: 8 }
+
+    def __init__(self, username, password, sink):
+        super().__init__(username, password)
+        self.sink = sink
+
+    def write(self, data):
+        """Send console input to the host"""
+        for i in range(0, len(data), SOL_MAX_TRANSMIT_BUFFER):
+            chunk = data[i:i + SOL_MAX_TRANSMIT_BUFFER]
+            self.send(SOL_DATA_TO_HOST, struct.pack('<H', len(chunk)) + chunk)
+
+    def message_size(self, data):
+        if data[0] == SOL_DATA_FROM_HOST:
+            return 10 + struct.unpack_from('<H', data, 8)[0] if len(data) >= 10 else None
+        return super().message_size(data)
+
+    def data_header(self, cmd):
+        return 10 if cmd == SOL_DATA_FROM_HOST else None
+
+    def data(self, view):
+        self.sink(view)
+
+    def handle(self, msg):
+        if msg[0] == START_SOL_REDIRECTION_REPLY:
+            if msg[1] != 0:
+                return self.fail(f'SOL redirection refused, status {msg[1]}')
+            self.running()
+            self.spawn(self.keepalive())
+        else:
+            super().handle(msg)
+
+    def authenticated(self):
+        # Transmit buffer size and timeout, overflow timeout, host
+        # session rx timeout, rx flush timeout and heartbeat interval
+        settings = struct.pack('<HHHHHHxxxx', SOL_MAX_TRANSMIT_BUFFER, 100, 0,
+                               10000, 0, SOL_HEARTBEAT_INTERVAL * 1000)
+        self.send(START_SOL_REDIRECTION, settings)
+
+    async def keepalive(self):
+        while not self.transport.is_closing():
+            await asyncio.sleep(SOL_HEARTBEAT_INTERVAL)
+            self.send(SOL_HEARTBEAT)
+
+class rotating_file:
+    """Append to 'path', moving it to path.1 ... path.<backups> once it
+    would grow beyond 'max_bytes'; with 0 it grows without limit"""
+
+    def __init__(self, path, max_bytes=0, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = open(path, 'ab', buffering=0)
+        self.size = self.file.tell()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        self.file = open(self.path, 'wb', buffering=0)
+        self.size = 0
+
+    def write(self, data):
+        if self.max_bytes and self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.close()
+
+async def sol_connect(host, username, password, sink, tls=False, timeout=None):
+    """Open a SOL session to 'host' and return its sol_protocol once
+    the console is running"""
+    return await redirection_connect(lambda: sol_protocol(username, password, sink),
+                                     host, tls, timeout)
+
+async def sol_attach(protocol, escape=b'\x1d'):
+    """Connect the terminal to the console of 'protocol' until 'escape'
+    (Ctrl-]) is typed or the session ends"""
+    import termios
+    import tty
+    loop = asyncio.get_running_loop()
+    fd = sys.stdin.fileno()
+
+    def key():
+        data = os.read(fd, 1024)
+        if not data or escape in data:
+            data = data.split(escape)[0]
+            if data:
+                protocol.write(data)
+            protocol.close()
+        else:
+            protocol.write(data)
+
+    saved = termios.tcgetattr(fd) if os.isatty(fd) else None
+    try:
+        if saved is not None:
+            tty.setraw(fd)
+        loop.add_reader(fd, key)
+        await protocol.closed
+    finally:
+        loop.remove_reader(fd)
+        if saved is not None:
+            termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+        protocol.close()
@@ -0,0 +1,557 @@
+"""Pure-Python asyncio WS-Man transport"""
+
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+import errno
+import re
+import socket
+import ssl
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit
+
+from .soap import XML_NS_SOAP_1_2, XML_NS_ADDRESSING, XML_NS_TRANSFER, \
+    XML_NS_ENUMERATION, XML_NS_WS_MAN, XML_NS_WSMAN_ID, WSA_TO_ANONYMOUS, \
+    xml_tag, wsman_doc, wsman_doc_parser
+
+class digest_auth:
+    """HTTP digest authentication state for one endpoint
+
+    The challenge is kept after the first 401 so that subsequent
+    requests authenticate up front with an incremented nonce count.
+    """
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.challenge = None
+        self.nc = 0
+
+    def set_challenge(self, header):
+        if not header.lower().startswith('digest '):
+            raise PermissionError(f'Unsupported authentication: {header}')
+        self.challenge = {k.lower(): v1 if v1 else v2 for k, v1, v2 in
+                          re.findall(r'(\w+)=(?:"([^"]*)"|([^,\s]*))',
+                                     header[7:])}
+        self.nc = 0
+
+    def header(self, method, path):
+        if self.challenge is None:
+            return None
+        c = self.challenge
+
+        def h(s):
+            return hashlib.md5(s.encode('utf-8')).hexdigest()
+
+        self.nc += 1
+        nc = '%08x' % self.nc
+        cnonce = os.urandom(8).hex()
+        ha1 = h(f"{self.username}:{c['realm']}:{self.password}")
+        ha2 = h(f'{method}:{path}')
+        qop = c.get('qop')
+        if qop:
+            qop = 'auth'
+            response = h(f"{ha1}:{c['nonce']}:{nc}:{cnonce}:{qop}:{ha2}")
+        else:
+            response = h(f"{ha1}:{c['nonce']}:{ha2}")
+        value = (f'Digest username="{self.username}", realm="{c["realm"]}", '
+                 f'nonce="{c["nonce"]}", uri="{path}", '
+                 f'response="{response}"')
+        if qop:
+            value += f', qop={qop}, nc={nc}, cnonce="{cnonce}"'
+        if 'opaque' in c:
+            value += f', opaque="{c["opaque"]}"'
+        if 'algorithm' in c:
+            value += f', algorithm={c["algorithm"]}'
+        return value
+
+class body_buffer:
+    """Response body kept as bytes"""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def feed(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def close(self):
+        return b''.join(self.chunks)
+
+class http_connection:
+    """One keep-alive HTTP/1.1 connection"""
+
+    # Largest piece of a response body read at once
+    read_size = 65536
+
+    def __init__(self, reader, writer, connect_time=0):
+        self.reader = reader
+        self.writer = writer
+        self.connect_time = connect_time
+        # When the status line of the last response came in
+        self.first_byte = None
+
+    def send(self, host, path, body, headers):
+        lines = [f'POST {path} HTTP/1.1', f'Host: {host}',
+                 'Content-Type: application/soap+xml;charset=UTF-8',
+                 f'Content-Length: {len(body)}']
+        lines.extend(f'{k}: {v}' for k, v in headers.items())
+        head = '\r\n'.join(lines) + '\r\n\r\n'
+        self.writer.write(head.encode('latin-1') + body)
+
+    async def request(self, host, path, body, headers, sink):
+        self.send(host, path, body, headers)
+        await self.writer.drain()
+        return await self.response(sink)
+
+    async def read_body(self, sink, size):
+        while size:
+            data = await self.reader.read(min(size, self.read_size))
+            if not data:
+                raise asyncio.IncompleteReadError(b'', size)
+            sink.feed(data)
+            size -= len(data)
+
+    async def response(self, sink):
+        """Read a response, passing the body to sink.feed() piece by
+        piece as it arrives, so that it can be parsed while it is
+        read. The body of a 401 is not passed on. Returns the status
+        code, the headers and whether the connection can be reused."""
+        status = await self.reader.readline()
+        self.first_byte = time.perf_counter()
+        if not status:
+            raise ConnectionResetError('Connection closed by peer')
+        version, code, _ = status.decode('latin-1').split(' ', 2)
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            k, _, v = line.decode('latin-1').partition(':')
+            response_headers[k.strip().lower()] = v.strip()
+        if code == '401':
+            sink = body_buffer()
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                await self.read_body(sink, size)
+                await self.reader.readline()
+        else:
+            await self.read_body(sink, int(response_headers.get('content-length', 0)))
+        keep_alive = (version == 'HTTP/1.1' and
+                      response_headers.get('connection', '').lower() != 'close')
+        return int(code), response_headers, keep_alive
+
+    def close(self):
+        self.writer.close()
+
+class http_pool:
+    """Pool of keep-alive connections to one endpoint"""
+
+    def __init__(self, host, port, ssl_context=None, max_connections=4):
+        self.host = host
+        self.port = port
+        self.ssl = ssl_context
+        self.idle = []
+        self.slots = asyncio.Semaphore(max_connections)
+
+    async def acquire(self):
+        await self.slots.acquire()
+        if self.idle:
+            return self.idle.pop(), True
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port,
+                                                           ssl=self.ssl)
+        except BaseException:
+            self.slots.release()
+            raise
+        return http_connection(reader, writer, time.perf_counter() - start), False
+
+    def release(self, conn, reuse):
+        if reuse:
+            self.idle.append(conn)
+        else:
+            conn.close()
+        self.slots.release()
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+class async_wsman_client:
+    """asyncio WS-Man client for one endpoint
+
+    Implements Identify, Get, Put and Invoke with the same call
+    signatures as the pywsman Client, but as coroutines; any number of
+    clients and requests can share one event loop. Enumerate, Pull
+    and Release return the undecoded response, to be parsed with a
+    wsman_item_parser. With a wsman_metrics, the time spent in each
+    phase of a request and retries are recorded.
+    """
+
+    def __init__(self, url, timeout=None, max_connections=4, metrics=None):
+        u = urlsplit(url)
+        self.pipelining = True
+        self.endpoint = f'{u.scheme}://{u.hostname}:{u.port}{u.path}'
+        self.host = f'{u.hostname}:{u.port}'
+        self.path = u.path or '/wsman'
+        self.timeout = timeout
+        self.auth = digest_auth(u.username, u.password)
+        self.metrics = metrics
+        ssl_context = ssl.create_default_context() if u.scheme == 'https' else None
+        self.pool = http_pool(u.hostname, u.port, ssl_context, max_connections)
+
+    def envelope(self, action, uri, body=None):
+        env = ET.Element(xml_tag(XML_NS_SOAP_1_2, 'Envelope'))
+        header = ET.SubElement(env, xml_tag(XML_NS_SOAP_1_2, 'Header'))
+        must = {xml_tag(XML_NS_SOAP_1_2, 'mustUnderstand'): 'true'}
+        if action is not None:
+            ET.SubElement(header, xml_tag(XML_NS_ADDRESSING, 'To')).text = self.endpoint
+            ET.SubElement(header, xml_tag(XML_NS_WS_MAN, 'ResourceURI'),
+                          must).text = uri
+            reply = ET.SubElement(header, xml_tag(XML_NS_ADDRESSING, 'ReplyTo'))
+            ET.SubElement(reply, xml_tag(XML_NS_ADDRESSING, 'Address'),
+                          must).text = WSA_TO_ANONYMOUS
+            ET.SubElement(header, xml_tag(XML_NS_ADDRESSING, 'Action'),
+                          must).text = action
+            ET.SubElement(header, xml_tag(XML_NS_ADDRESSING, 'MessageID'),
+                          must).text = 'uuid:' + str(uuid.uuid4())
+            if self.timeout:
+                ET.SubElement(header, xml_tag(XML_NS_WS_MAN, 'OperationTimeout')
+                              ).text = 'PT%dS' % self.timeout
+        b = ET.SubElement(env, xml_tag(XML_NS_SOAP_1_2, 'Body'))
+        if body is not None:
+            b.append(body)
+        return ET.tostring(env, encoding='utf-8')
+
+    async def _post(self, data, sink_factory):
+        # One retry each for a stale keep-alive connection and for
+        # a (re-)issued digest challenge
+        metrics = self.metrics
+        for attempt in range(3):
+            conn, reused = await self.pool.acquire()
+            keep_alive = False
+            try:
+                if metrics is not None and not reused:
+                    metrics.phase(self.host, 'connect', conn.connect_time)
+                headers = {}
+                auth = self.auth.header('POST', self.path)
+                if auth:
+                    headers['Authorization'] = auth
+                body = sink_factory()
+                sent = time.perf_counter()
+                try:
+                    code, h, keep_alive = await conn.request(
+                        self.host, self.path, data, headers, body)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if reused:
+                        # The peer timed out the idle connection; retry
+                        # on a fresh one
+                        if metrics is not None:
+                            metrics.retry(self.host, 'stale connection')
+                        continue
+                    raise
+                if code == 401:
+                    if metrics is not None:
+                        metrics.phase(self.host, 'auth', time.perf_counter() - sent)
+                    if auth and 'stale=true' not in h.get('www-authenticate', '').lower():
+                        raise PermissionError(f'Authentication failed for {self.host}')
+                    if metrics is not None:
+                        metrics.retry(self.host, 'stale nonce' if auth else 'challenge')
+                    self.auth.set_challenge(h.get('www-authenticate', ''))
+                    continue
+                if metrics is not None:
+                    metrics.phase(self.host, 'firmware', conn.first_byte - sent)
+                    metrics.phase(self.host, 'parse', time.perf_counter() - conn.first_byte)
+                return code, body
+            finally:
+                self.pool.release(conn, keep_alive)
+        raise PermissionError(f'Authentication failed for {self.host}')
+
+    async def _pipeline(self, data, sink_factory):
+        """Write all requests on one connection before reading the
+        responses; returns the responses received before the first
+        one the endpoint refused."""
+        conn, reused = await self.pool.acquire()
+        keep_alive = False
+        responses = []
+        if self.metrics is not None and not reused:
+            self.metrics.phase(self.host, 'connect', conn.connect_time)
+        try:
+            for d in data:
+                conn.send(self.host, self.path, d,
+                          {'Authorization': self.auth.header('POST', self.path)})
+            await conn.writer.drain()
+            for d in data:
+                body = sink_factory()
+                code, h, keep_alive = await conn.response(body)
+                if code == 401 or not keep_alive:
+                    break
+                responses.append((code, body))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            # Unread responses make the connection unusable
+            self.pool.release(conn, keep_alive and len(responses) == len(data))
+        return responses
+
+    async def _wait(self, coro):
+        if self.timeout:
+            return await asyncio.wait_for(coro, self.timeout)
+        return await coro
+
+    def _dump(self, options, data):
+        if options is not None and getattr(options, 'dump_request', False):
+            print(data.decode('utf-8'), file=getattr(options, 'dump_file', None))
+
+    def _parse(self, code, body):
+        if not body.size:
+            raise ConnectionError(f'HTTP {code} from {self.host}')
+        # SOAP faults come with HTTP 400/500, hand them to the caller
+        return body.close()
+
+    async def request(self, options, data):
+        """Post 'data' and return the response as wsman_doc, parsed
+        while it is read"""
+        self._dump(options, data)
+        code, body = await self._wait(self._post(data, wsman_doc_parser))
+        return self._parse(code, body)
+
+    async def request_raw(self, options, data):
+        """Post 'data' and return the undecoded response"""
+        self._dump(options, data)
+        code, body = await self._wait(self._post(data, body_buffer))
+        return self._parse(code, body)
+
+    async def pipeline(self, options, requests):
+        """Issue several requests back-to-back over one connection
+
+        'requests' is a list of tuples naming the client method and its
+        arguments without options, e.g. ('get', uri). Requests are
+        pipelined once digest auth is established; an endpoint which
+        rejects pipelining gets the remaining ones sequentially.
+        Returns the response documents in request order.
+        """
+        data = [getattr(self, r[0] + '_request')(*r[1:]) for r in requests]
+        for d in data:
+            self._dump(options, d)
+        responses = []
+        if self.auth.challenge is None or not self.pipelining:
+            responses.append(await self._wait(self._post(data[0], wsman_doc_parser)))
+        if self.pipelining and len(data) - len(responses) > 1:
+            pending = data[len(responses):]
+            pipelined = await self._wait(self._pipeline(pending, wsman_doc_parser))
+            if len(pipelined) < len(pending):
+                self.pipelining = False
+                if self.metrics is not None:
+                    self.metrics.retry(self.host, 'pipelining refused')
+            responses.extend(pipelined)
+        for d in data[len(responses):]:
+            responses.append(await self._wait(self._post(d, wsman_doc_parser)))
+        return [self._parse(code, body) for code, body in responses]
+
+    def identify_request(self):
+        body = ET.Element(xml_tag(XML_NS_WSMAN_ID, 'Identify'))
+        return self.envelope(None, None, body)
+
+    def get_request(self, uri):
+        return self.envelope(XML_NS_TRANSFER + '/Get', uri)
+
+    def put_request(self, uri, data, size=None, encoding='utf-8'):
+        if isinstance(data, wsman_doc):
+            # Serialized only once, as part of the envelope
+            elem = data.elem
+        else:
+            if isinstance(data, bytes):
+                data = data.decode(encoding)
+            elem = wsman_doc.parse(str(data)).elem
+        if elem.tag == xml_tag(XML_NS_SOAP_1_2, 'Envelope'):
+            # Accept a full Get response as pywsman does
+            elem = elem.find(xml_tag(XML_NS_SOAP_1_2, 'Body'))[0]
+        return self.envelope(XML_NS_TRANSFER + '/Put', uri, elem)
+
+    def invoke_request(self, uri, method, data):
+        if data is None:
+            elem = ET.Element(xml_tag(uri, method + '_INPUT'))
+        elif isinstance(data, wsman_doc):
+            elem = data.elem
+        else:
+            elem = wsman_doc.parse(str(data)).elem
+        return self.envelope(uri + '/' + method, uri, elem)
+
+    def enumerate_request(self, uri, max_elements):
+        body = ET.Element(xml_tag(XML_NS_ENUMERATION, 'Enumerate'))
+        # Return the first items with the response, saving one Pull
+        ET.SubElement(body, xml_tag(XML_NS_WS_MAN, 'OptimizeEnumeration'))
+        ET.SubElement(body, xml_tag(XML_NS_WS_MAN, 'MaxElements')
+                      ).text = str(max_elements)
+        return self.envelope(XML_NS_ENUMERATION + '/Enumerate', uri, body)
+
+    def pull_request(self, uri, context, max_elements):
+        body = ET.Element(xml_tag(XML_NS_ENUMERATION, 'Pull'))
+        ET.SubElement(body, xml_tag(XML_NS_ENUMERATION, 'EnumerationContext')
+                      ).text = context
+        ET.SubElement(body, xml_tag(XML_NS_ENUMERATION, 'MaxElements')
+                      ).text = str(max_elements)
+        return self.envelope(XML_NS_ENUMERATION + '/Pull', uri, body)
+
+    def release_request(self, uri, context):
+        body = ET.Element(xml_tag(XML_NS_ENUMERATION, 'Release'))
+        ET.SubElement(body, xml_tag(XML_NS_ENUMERATION, 'EnumerationContext')
+                      ).text = context
+        return self.envelope(XML_NS_ENUMERATION + '/Release', uri, body)
+
+    async def identify(self, options):
+        return await self.request(options, self.identify_request())
+
+    async def get(self, options, uri):
+        return await self.request(options, self.get_request(uri))
+
+    async def put(self, options, uri, data, size=None, encoding='utf-8'):
+        return await self.request(options,
+                                  self.put_request(uri, data, size, encoding))
+
+    async def invoke(self, options, uri, method, data):
+        return await self.request(options,
+                                  self.invoke_request(uri, method, data))
+
+    async def enumerate(self, options, uri, max_elements):
+        return await self.request_raw(options,
+                                      self.enumerate_request(uri, max_elements))
+
+    async def pull(self, options, uri, context, max_elements):
+        return await self.request_raw(options,
+                                      self.pull_request(uri, context, max_elements))
+
+    async def release(self, options, uri, context):
+        return await self.request_raw(options,
+                                      self.release_request(uri, context))
+
+    async def close(self):
+        self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+# Errors of connection attempts, before anything was sent
+connect_errnos = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH,
+                  errno.EHOSTDOWN)
+
+wsman_loop = None
+wsman_loop_lock = threading.Lock()
+
+def wsman_event_loop():
+    """Return the event loop shared by all wsman_sync_client instances,
+    starting its thread on first use"""
+    global wsman_loop
+    with wsman_loop_lock:
+        if wsman_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='wsman-loop',
+                             daemon=True).start()
+            wsman_loop = loop
+    return wsman_loop
+
+class wsman_sync_client:
+    """Blocking front-end for async_wsman_client
+
+    Requests run on the shared wsman event loop, so blocking callers
+    in any number of threads share a single I/O thread. Like the
+    pywsman Client, failed requests return None and the error is
+    available from last_error(). After abort(), from any thread, the
+    request in progress and all further ones fail right away.
+    """
+
+    def __init__(self, url, timeout=None, metrics=None):
+        self.loop = wsman_event_loop()
+        self.client = async_wsman_client(url, timeout, metrics=metrics)
+        self.error = None
+        self.future = None
+        self.aborted = False
+
+    def _run(self, coro):
+        if self.aborted:
+            coro.close()
+            self.error = ConnectionAbortedError('request abandoned')
+            return None
+        future = self.future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            self.error = ConnectionAbortedError('request abandoned')
+            return None
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ET.ParseError) as e:
+            self.error = e
+            return None
+
+    def abort(self):
+        self.aborted = True
+        future = self.future
+        if future is not None:
+            # Cancels the request on the event loop as well
+            future.cancel()
+
+    def last_error(self):
+        return self.error
+
+    def last_error_kind(self):
+        """Classify last_error() as 'connect' if no connection could be
+        made, 'auth', 'timeout', or None"""
+        e = self.error
+        if isinstance(e, PermissionError):
+            return 'auth'
+        # Abandoned requests took too long as well
+        if isinstance(e, (asyncio.TimeoutError, ConnectionAbortedError)):
+            return 'timeout'
+        if isinstance(e, socket.gaierror) or \
+           getattr(e, 'errno', None) in connect_errnos:
+            return 'connect'
+        return None
+
+    def identify(self, options):
+        return self._run(self.client.identify(options))
+
+    def get(self, options, uri):
+        return self._run(self.client.get(options, uri))
+
+    def put(self, options, uri, data, size, encoding):
+        return self._run(self.client.put(options, uri, data, size, encoding))
+
+    def invoke(self, options, uri, method, data):
+        return self._run(self.client.invoke(options, uri, method, data))
+
+    def enumerate(self, options, uri, max_elements):
+        return self._run(self.client.enumerate(options, uri, max_elements))
+
+    def pull(self, options, uri, context, max_elements):
+        return self._run(self.client.pull(options, uri, context, max_elements))
+
+    def release(self, options, uri, context):
+        return self._run(self.client.release(options, uri, context))
+
+    def pipeline(self, options, requests):
+        docs = self._run(self.client.pipeline(options, requests))
+        if docs is None:
+            return [None] * len(requests)
+        return docs
+
+    def close(self):
+        # Also after abort()
+        future = asyncio.run_coroutine_threadsafe(self.client.close(), self.loop)
+        try:
+            future.result()
+        except OSError:
+            pass